@@ -1,14 +1,37 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
+import anyio
+import asyncio
+import functools
+import json
 import os
+import time
 import uuid
-import threading
-from main import generate_video_from_json
+from contextlib import asynccontextmanager
+from scheduler import JobScheduler, QueueFull
+from job_store import get_job_store, public_job
+from result_cache import cache_stats
+from hls import playlist_url, stream_file
+from downloads import plan_download
+from draw_image import SCROLL_MODES
+from batches import BATCH_MAX_ITEMS, batch_status
+from metrics import render_metrics
 
-app = FastAPI()
+# Store job status, shared by every server worker on this host
+jobs = get_job_store()
+scheduler = JobScheduler(jobs)
+
+@asynccontextmanager
+async def lifespan(app):
+    # Each server process runs its own queue, started once it is serving
+    await anyio.to_thread.run_sync(scheduler.start)
+    yield
+    scheduler.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -19,14 +42,77 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Store job status
-jobs = {}
+# How often /events checks the store for changes, and how long a quiet
+# stream may go before a keep-alive comment is sent
+EVENT_POLL_SECONDS = 0.5
+EVENT_KEEPALIVE_SECONDS = 15
+
+class RangeFileResponse(Response):
+    """Sends one byte span of a file as planned by downloads.plan_download.
+
+    Uses the ASGI zero-copy or path-send extensions when the server offers
+    them, so the file never passes through Python; otherwise it is read in
+    chunks off the event loop.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, path, status_code, headers, span, media_type):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.span = span
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.span is None or scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        start, end = self.span
+        extensions = scope.get("extensions") or {}
+        if "http.response.zerocopysend" in extensions:
+            with open(self.path, "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f, "offset": start, "count": end - start + 1})
+            return
+        if "http.response.pathsend" in extensions and self.status_code == 200:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            return
+
+        fd = await anyio.to_thread.run_sync(os.open, self.path, os.O_RDONLY)
+        try:
+            offset = start
+            while offset <= end:
+                chunk = await anyio.to_thread.run_sync(os.pread, fd, min(self.chunk_size, end - offset + 1), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": offset <= end})
+            if offset <= end:
+                # The file shrank under us; end the response rather than hang
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            os.close(fd)
 
 class GenerationRequest(BaseModel):
     contact_name: str
     contact_gender: str
     your_gender: str
     convo: list
+    scroll_mode: Optional[str] = None
+    preview: bool = False
+    stream: bool = False
+
+class BatchRequest(BaseModel):
+    items: List[GenerationRequest]
+
+def job_update(job_id):
+    """A job's public record and queue position, or None if there is no such job.
+
+    Reads the store, so async handlers call it on a worker thread.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return None
+    return {**public_job(job), 'queue_position': scheduler.queue_position(job_id)}
 
 @app.get("/")
 async def read_root():
@@ -34,43 +120,121 @@ async def read_root():
 
 @app.post("/generate")
 async def generate(data: GenerationRequest):
+    if data.scroll_mode is not None and data.scroll_mode not in SCROLL_MODES:
+        raise HTTPException(status_code=400, detail=f"scroll_mode must be one of {', '.join(SCROLL_MODES)}")
+
     job_id = str(uuid.uuid4())
-    jobs[job_id] = {
-        'status': 'processing',
-        'progress': 0,
-        'video_path': None,
-        'error': None
-    }
-
-    def generate_video_task():
-        try:
-            output_path = generate_video_from_json(data.dict(), job_id=job_id)
-            jobs[job_id]['status'] = 'completed'
-            jobs[job_id]['video_path'] = output_path
-        except Exception as e:
-            jobs[job_id]['status'] = 'error'
-            jobs[job_id]['error'] = str(e)
 
-    thread = threading.Thread(target=generate_video_task)
-    thread.daemon = True
-    thread.start()
+    try:
+        # The store may wait on a database lock; keep that off the event loop
+        job_id, outcome = await anyio.to_thread.run_sync(scheduler.submit, job_id, data.dict())
+    except QueueFull as e:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Too many jobs queued, try again later"},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    return {"job_id": job_id, "cache": outcome}
+
+@app.post("/generate/batch")
+async def generate_batch(batch: BatchRequest):
+    """Queue many conversations at once; follow them with GET /batch/{batch_id}."""
+    max_items = min(BATCH_MAX_ITEMS, scheduler.batch_capacity())
+    if not batch.items or len(batch.items) > max_items:
+        raise HTTPException(status_code=400, detail=f"A batch needs 1 to {max_items} items")
+    for i, item in enumerate(batch.items):
+        if item.scroll_mode is not None and item.scroll_mode not in SCROLL_MODES:
+            raise HTTPException(status_code=400, detail=f"items[{i}]: scroll_mode must be one of {', '.join(SCROLL_MODES)}")
+
+    batch_id = str(uuid.uuid4())
+    try:
+        items = await anyio.to_thread.run_sync(scheduler.submit_batch, batch_id, [item.dict() for item in batch.items])
+    except QueueFull as e:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Too many jobs queued for this batch, try again later"},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    return {"batch_id": batch_id, "items": items}
+
+@app.get("/batch/{batch_id}")
+async def batch_progress(batch_id: str):
+    batch = await anyio.to_thread.run_sync(jobs.get_batch, batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return await anyio.to_thread.run_sync(batch_status, jobs, batch)
+
+@app.get("/status")
+async def service_status():
+    stats = await anyio.to_thread.run_sync(scheduler.stats)
+    return {"scheduler": stats, "result_cache": await anyio.to_thread.run_sync(cache_stats, jobs)}
 
-    return {"job_id": job_id}
+@app.get("/metrics")
+async def prometheus_metrics():
+    text = await anyio.to_thread.run_sync(render_metrics, jobs, scheduler)
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
 
 @app.get("/status/{job_id}")
 async def status(job_id: str):
-    if job_id not in jobs:
+    update = await anyio.to_thread.run_sync(job_update, job_id)
+    if update is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    return jobs[job_id]
+    return {**update, 'stream_url': playlist_url(job_id)}
 
-@app.get("/download/{job_id}")
-async def download(job_id: str):
-    if job_id not in jobs or jobs[job_id]['status'] != 'completed':
+@app.get("/events/{job_id}")
+async def events(job_id: str):
+    """Server-Sent Events stream of a job's status, one event per change."""
+    if await anyio.to_thread.run_sync(jobs.get, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def stream():
+        last_state = None
+        last_sent = time.monotonic()
+        while True:
+            update = await anyio.to_thread.run_sync(job_update, job_id)
+            if update is None:
+                break
+            # The ETA moves on every poll; only push when real state changes
+            state = {k: v for k, v in update.items() if k != 'eta_seconds'}
+            if state != last_state:
+                yield f"event: progress\ndata: {json.dumps(update)}\n\n"
+                last_state = state
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > EVENT_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            if update['status'] in ('completed', 'error'):
+                break
+            await asyncio.sleep(EVENT_POLL_SECONDS)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.api_route("/download/{job_id}", methods=["GET", "HEAD"])
+async def download(job_id: str, request: Request):
+    job = await anyio.to_thread.run_sync(jobs.get, job_id)
+    if job is None or job['status'] != 'completed':
         raise HTTPException(status_code=404, detail="Video not ready")
-    
-    video_path = jobs[job_id]['video_path']
-    return FileResponse(
-        path=video_path,
-        filename=f"chat_video_{job_id}.mp4",
-        media_type="video/mp4"
-    ) 
\ No newline at end of file
+
+    video_path = job['video_path']
+    try:
+        status_code, headers, span = await anyio.to_thread.run_sync(
+            functools.partial(plan_download, video_path, request.headers, filename=f"chat_video_{job_id}.mp4")
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=410, detail="Video expired")
+    return RangeFileResponse(video_path, status_code, headers, span, media_type="video/mp4")
+
+@app.get("/stream/{job_id}/{name}")
+async def stream_segment(job_id: str, name: str):
+    """HLS playlist and segments, available while the job is still rendering."""
+    job = await anyio.to_thread.run_sync(jobs.get, job_id)
+    found = await anyio.to_thread.run_sync(stream_file, job_id, name) if job is not None else None
+    if found is None:
+        raise HTTPException(status_code=404, detail="Stream not available")
+    path, media_type, cache_control = found
+    return FileResponse(path=path, media_type=media_type, headers={"Cache-Control": cache_control})
@@ -1,55 +1,178 @@
 import os
-from openai import OpenAI
-from dotenv import load_dotenv
-import httpx
-
-load_dotenv(".env.local")  # Load the OpenAI API key
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OpenAI API key not found in environment variables")
-
-# Create a custom HTTP client without proxy settings
-http_client = httpx.Client(
-    base_url="https://api.openai.com/v1",
-    headers={"Authorization": f"Bearer {api_key}"},
-    follow_redirects=True,
-    timeout=30.0,
-)
-
-# Initialize OpenAI client with the custom HTTP client
-client = OpenAI(
-    api_key=api_key,
-    http_client=http_client
-)
-
-def generate_voice_clips(convo, output_subdir="output/audio", user_voice="nova", other_voice="shimmer", model="tts-1"):
-    base_dir = os.path.dirname(__file__)
-    output_dir = os.path.join(base_dir, output_subdir)
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from tts_cache import TTSCache
+from metrics import metrics
+from openai_scheduler import openai_requests
+from pipeline import prefetch
 
-    os.makedirs(output_dir, exist_ok=True)
+# How many lines are synthesized at once per conversation
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", 4))
+# Preview jobs synthesize their lines into the TTS cache in the background,
+# so the full render that usually follows doesn't wait for speech
+PREVIEW_WARM_TTS = os.getenv("PREVIEW_WARM_TTS", "1") != "0"
+
+# Synthesized lines shared across jobs, workers and restarts
+tts_cache = TTSCache()
+
+# Background pool for warm_voice_clips, started on first use
+_warm_pool = None
+_warm_lock = threading.Lock()
+
+def estimate_speech_duration(text):
+    """Rough spoken length in seconds, for lines that have no audio."""
+    return max(1.0, len(text) / 15)
+
+def synthesize_line(text, voice, output_path, model="tts-1", job=None):
+    """Write the spoken line to `output_path`, from the TTS cache if it's there.
+
+    The request is paced, retried and hedged by openai_scheduler, and counts
+    against `job`'s share of the speech endpoint.
+    """
+    with metrics.span("tts_line"):
+        if tts_cache.get(model, voice, text, output_path):
+            metrics.inc("gentext_tts_cache_total", result="hit")
+            return output_path
+        metrics.inc("gentext_tts_cache_total", result="miss")
+
+        response = openai_requests.call(
+            "speech",
+            lambda client: client.audio.speech.with_raw_response.create(model=model, voice=voice, input=text),
+            job=job, hedge=True,
+        )
+        # The path may be a hard link into the cache from an earlier job, so
+        # replace it rather than writing through it
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        with open(output_path, "wb") as f:
+            f.write(response.content)
+        tts_cache.put(model, voice, text, output_path)
+        return output_path
+
+def voice_for(msg, user_voice, other_voice):
+    return user_voice if msg["sender"].lower() == "you" else other_voice
+
+def warm_voice_clips(convo, user_voice="nova", other_voice="shimmer", model="tts-1"):
+    """Synthesize lines into the TTS cache in the background and return at once.
+
+    For preview jobs, which don't wait for speech: the full render of the
+    same conversation then finds every line cached. Lines already cached
+    are skipped, and nothing happens when the cache is off.
+    """
+    global _warm_pool
+    if not (PREVIEW_WARM_TTS and tts_cache.enabled):
+        return
+    with _warm_lock:
+        if _warm_pool is None:
+            _warm_pool = ThreadPoolExecutor(max_workers=TTS_CONCURRENCY)
+    for msg in convo:
+        _warm_pool.submit(_warm_line, msg["text"], voice_for(msg, user_voice, other_voice), model)
+
+def _warm_line(text, voice, model):
+    if tts_cache.contains(model, voice, text):
+        return
+    fd, path = tempfile.mkstemp(suffix=".mp3")
+    os.close(fd)
+    try:
+        # Counted as a job of its own, so it takes turns with the render
+        # that is running now rather than holding it up
+        synthesize_line(text, voice, path, model=model, job="preview-warm")
+    except Exception as e:
+        print(f"[WARN] Could not pre-synthesize a line: {e}")
+    finally:
+        os.remove(path)
 
-    paths = []
+def generate_voice_clips(convo, output_subdir="output/audio", user_voice="nova", other_voice="shimmer", model="tts-1", max_workers=None, workspace=None, progress_callback=None):
+    """Synthesize every line, up to `max_workers` at a time.
 
-    for i, msg in enumerate(convo):
+    Lines are written to the job's `workspace` when one is given, and
+    `progress_callback(done, total)` is called as each line finishes. Returns
+    one entry per message, in conversation order. Lines that failed are None,
+    so audio never shifts onto the wrong message.
+    """
+    return list(iter_voice_clips(
+        convo, output_subdir=output_subdir, user_voice=user_voice, other_voice=other_voice, model=model,
+        max_workers=max_workers, workspace=workspace, progress_callback=progress_callback,
+    ))
+
+def iter_voice_clips(convo, output_subdir="output/audio", user_voice="nova", other_voice="shimmer", model="tts-1", max_workers=None, workspace=None, progress_callback=None, total=None, finished=None, on_line=None):
+    """Like generate_voice_clips, but yield each path as soon as it is ready.
+
+    Every line is requested as soon as its message is known: all at once
+    for a list, or one by one as they arrive when `convo` is a stream of
+    messages still being written (pass the expected count as `total` for
+    progress). Paths come out in conversation order, so line k is yielded
+    once it and every line before it have finished, while later lines are
+    still being synthesized.
+
+    `finished` maps line numbers to paths (or None) an earlier run of the
+    job already settled on; those are yielded as they are, without a
+    request. `on_line(i, path)` is called as each new line is saved.
+    """
+    finished = finished or {}
+    if workspace is not None:
+        output_dir = workspace.audio_dir
+    else:
+        base_dir = os.path.dirname(__file__)
+        output_dir = os.path.join(base_dir, output_subdir)
+
+    os.makedirs(output_dir, exist_ok=True)
+    job = workspace.job_id if workspace is not None else None
+
+    def generate_line(i, msg):
         text = msg["text"]
         sender = msg["sender"]
 
         # Choose voice based on sender
-        voice = user_voice if sender.lower() == "you" else other_voice
+        voice = voice_for(msg, user_voice, other_voice)
 
         output_path = os.path.join(output_dir, f"line_{i:03}.mp3")
 
         print(f"[INFO] Generating voice for '{sender}' (voice='{voice}')...")
         try:
-            response = client.audio.speech.create(
-                model=model,
-                voice=voice,
-                input=text
-            )
-            response.stream_to_file(output_path)
+            synthesize_line(text, voice, output_path, model=model, job=job)
             print(f"Saved to {output_path}")
-            paths.append(output_path)
+            if on_line:
+                on_line(i, output_path)
+            return output_path
         except Exception as e:
             print(f"Skipping line {i} due to error: {e}")
+            return None
+
+    if total is None:
+        if not convo:
+            return
+        total = len(convo)
+
+    done = 0
+    done_lock = threading.Lock()
+
+    def line_done(_):
+        nonlocal done
+        with done_lock:
+            done += 1
+            count = done
+        if progress_callback:
+            progress_callback(count, max(total, count))
+
+    def submit(i, msg):
+        if i in finished:
+            future = Future()
+            future.set_result(finished[i])
+        else:
+            future = pool.submit(generate_line, i, msg)
+        future.add_done_callback(line_done)
+        return future
 
-    return paths
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_workers or TTS_CONCURRENCY, total)))
+    # A helper thread requests each line as soon as its message is known,
+    # however far ahead of the consumer that is
+    futures = prefetch((submit(i, msg) for i, msg in enumerate(convo)), max_ahead=0)
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        # A consumer that stops early doesn't wait for lines it won't use
+        futures.close()
+        pool.shutdown(wait=False, cancel_futures=True)
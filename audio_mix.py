@@ -0,0 +1,123 @@
+import subprocess
+import tempfile
+from functools import lru_cache
+import numpy as np
+from encoder import get_ffmpeg_exe
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+
+
+def decode_audio(path, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    """Decode any audio file ffmpeg can read into a float32 (samples, channels) array."""
+    cmd = [
+        get_ffmpeg_exe(), "-loglevel", "error", "-i", path,
+        "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(channels), "-ar", str(sample_rate), "pipe:1",
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not decode {path}: {result.stderr.decode(errors='replace').strip()}")
+    return np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, channels)
+
+
+@lru_cache(maxsize=4)
+def load_sound_effect(path):
+    """Decode a short effect once per process; callers must not modify it."""
+    samples = decode_audio(path)
+    samples.flags.writeable = False
+    return samples
+
+
+def duration_of(samples, sample_rate=SAMPLE_RATE):
+    return len(samples) / sample_rate
+
+
+class AudioTimeline:
+    """A soundtrack built by adding clips at offsets into one PCM buffer.
+
+    Clips are collected with add() and mixed by drain(), a stretch of track
+    at a time, into a preallocated float32 buffer with one vectorized add
+    per clip.
+    """
+
+    def __init__(self, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._clips = []
+        self._drained = 0
+
+    def add(self, samples, start, gain=1.0, max_duration=None):
+        if max_duration is not None:
+            samples = samples[:int(round(max_duration * self.sample_rate))]
+        self._clips.append((int(round(start * self.sample_rate)), samples, gain))
+
+    def drain(self, until):
+        """Mix and return the part of the track before `until` seconds not drained yet.
+
+        For timelines that are built in time order: once nothing more will be
+        added before `until`, the track up to there is final and can be
+        handed on while later clips are still being added. Clips that end
+        before `until` are dropped.
+        """
+        start = self._drained
+        end = max(start, int(round(until * self.sample_rate)))
+        track = np.zeros((end - start, self.channels), dtype=np.float32)
+        remaining = []
+        for offset, samples, gain in self._clips:
+            lo, hi = max(offset, start), min(offset + len(samples), end)
+            if hi > lo:
+                part = samples[lo - offset:hi - offset]
+                track[lo - start:hi - start] += part if gain == 1.0 else part * np.float32(gain)
+            if offset + len(samples) > end:
+                remaining.append((offset, samples, gain))
+        self._clips = remaining
+        self._drained = end
+        np.clip(track, -1.0, 1.0, out=track)
+        return track
+
+
+class AudioEncoder:
+    """Encodes PCM to AAC in a background ffmpeg process as it is written.
+
+    Feed it consecutive float32 chunks with write(); the compressed track is
+    ready in `output_path` as soon as close() returns, instead of the whole
+    soundtrack being encoded after the last chunk. The container follows the
+    file extension; with ".aac" (ADTS) each packet is written out as soon as
+    it is encoded, so the file can be read while it grows.
+    """
+
+    def __init__(self, output_path, sample_rate=SAMPLE_RATE, channels=CHANNELS, bitrate="128k"):
+        self.output_path = output_path
+        self.samples_written = 0
+        cmd = [
+            get_ffmpeg_exe(), "-y", "-loglevel", "error",
+            "-f", "f32le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0",
+            "-c:a", "aac", "-b:a", bitrate, "-flush_packets", "1", output_path,
+        ]
+        # stderr goes to a file so a chatty ffmpeg can never block on a full pipe
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self._stderr)
+
+    def write(self, samples):
+        if len(samples):
+            self._proc.stdin.write(np.ascontiguousarray(samples, dtype=np.float32).tobytes())
+            self.samples_written += len(samples)
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._proc.wait()
+        self._stderr.seek(0)
+        stderr = self._stderr.read().decode(errors="replace")
+        self._stderr.close()
+        if self._proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed ({self._proc.returncode}): {stderr.strip()[-2000:]}")
+        return self.output_path
+
+    def abort(self):
+        if self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        self._stderr.close()
@@ -0,0 +1,58 @@
+import os
+import time
+from job_store import public_job
+
+# Most requests one /generate/batch call may carry
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 500))
+
+FINISHED_STATUSES = ("completed", "error")
+
+
+def batch_status(store, batch):
+    """Per-item status of a batch plus counts and a throughput report.
+
+    Throughput is measured from when the batch was submitted: items
+    finished per minute, mean render time of the jobs the batch started
+    (reused videos don't count), and an ETA for the rest at that rate.
+    """
+    jobs = store.get_many(item["job_id"] for item in batch["items"])
+    created_at = batch["created_at"]
+
+    items = []
+    counts = {"queued": 0, "processing": 0, "completed": 0, "error": 0}
+    render_seconds = []
+    last_finished = created_at
+    for item in batch["items"]:
+        job = jobs.get(item["job_id"])
+        if job is None:
+            counts["missing"] = counts.get("missing", 0) + 1
+            items.append({**item, "status": "missing"})
+            continue
+        counts[job["status"]] = counts.get(job["status"], 0) + 1
+        entry = {**item, **public_job(job)}
+        if job["status"] == "completed":
+            entry["download_url"] = f"/download/{item['job_id']}"
+        items.append(entry)
+        if job["status"] in FINISHED_STATUSES:
+            last_finished = max(last_finished, job["updated_at"])
+            if job["status"] == "completed" and job["started_at"] and job["started_at"] >= created_at:
+                render_seconds.append(job["updated_at"] - job["started_at"])
+
+    total = len(batch["items"])
+    finished = counts["completed"] + counts["error"]
+    done = finished + counts.get("missing", 0) >= total
+    elapsed = (last_finished if done else time.time()) - created_at
+    rate = finished / elapsed if elapsed > 0 else None
+    return {
+        "batch_id": batch["batch_id"],
+        "done": done,
+        "total": total,
+        "counts": counts,
+        "throughput": {
+            "elapsed_seconds": round(elapsed, 1),
+            "items_per_minute": round(rate * 60, 2) if rate else None,
+            "mean_render_seconds": round(sum(render_seconds) / len(render_seconds), 1) if render_seconds else None,
+            "eta_seconds": 0 if done else (round((total - finished) / rate, 1) if rate else None),
+        },
+        "items": items,
+    }
@@ -0,0 +1,440 @@
+"""Offline benchmarks for the video pipeline.
+
+Starts the stub OpenAI server, then measures each pipeline stage and the
+whole job for synthetic conversations of several sizes, and optionally the
+HTTP entry points end to end. Every pipeline measurement runs in a fresh
+process, so peak RSS belongs to that run alone. Results are written as
+JSON so runs from different releases can be compared.
+
+    python -m benchmarks.run --sizes 5,20,50,200,500 --output bench.json
+    python -m benchmarks.run --sizes 50 --compare bench.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ("chat", "tts", "frames", "audio", "encode", "end_to_end", "prompt", "prompt_blocking")
+SERVERS = ("fastapi", "flask")
+PAUSE_SECONDS = 0.5
+FPS = 24
+
+
+def bench_request(n_messages, seed=0):
+    """A /generate payload with a synthetic conversation of `n_messages`."""
+    from benchmarks.stub_openai import fake_conversation
+
+    return {
+        "contact_name": f"Alice Bench{seed}",
+        "contact_gender": "female",
+        "your_gender": "male",
+        "convo": fake_conversation(n_messages, names=("Alice", "You"), seed=seed),
+    }
+
+
+class Usage:
+    """Wall time, CPU time (this process plus finished children) and peak RSS.
+
+    Peak RSS is this process's own; ffmpeg children aren't included, since
+    Linux reports a forked child's peak from before it exec'd.
+    """
+
+    def __init__(self):
+        self.excluded_wall = 0.0
+        self.excluded_cpu = 0.0
+
+    def __enter__(self):
+        self._start = self._sample()
+        return self
+
+    def __exit__(self, *exc):
+        self._end = self._sample()
+
+    @staticmethod
+    def _sample():
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.perf_counter(), own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+    def result(self):
+        wall = self._end[0] - self._start[0] - self.excluded_wall
+        cpu = (self._end[1] - self._start[1]) + (self._end[2] - self._start[2]) - self.excluded_cpu
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        return {
+            "wall_s": round(wall, 3),
+            "cpu_s": round(cpu, 3),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20, 1),
+        }
+
+
+def timed_iter(iterable, usage):
+    """Yield from `iterable`, charging the time spent producing items to `usage` as excluded."""
+    iterator = iter(iterable)
+    while True:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            usage.excluded_wall += time.perf_counter() - wall
+            usage.excluded_cpu += time.thread_time() - cpu
+        yield item
+
+
+def measure_stage(stage, n_messages, seed=0):
+    """Run one stage on a synthetic conversation and report its cost.
+
+    Runs in a worker process. Inputs a stage needs from earlier stages are
+    prepared before the clock starts.
+    """
+    sys.path.insert(0, ROOT)
+    from audio import estimate_speech_duration, iter_voice_clips
+    from workspace import JobWorkspace, _tree_size, stream_dir
+
+    data = bench_request(n_messages, seed)
+    convo = data["convo"]
+    job_id = f"bench-{stage}-{n_messages}-{uuid.uuid4().hex[:8]}"
+    detail = {}
+
+    with JobWorkspace(job_id) as workspace:
+        if stage == "chat":
+            from gen_messages import generate_fake_convo
+
+            with Usage() as usage:
+                generated = generate_fake_convo(n_messages=n_messages)
+            output_bytes = len(json.dumps(generated))
+            detail["messages"] = len(generated)
+
+        elif stage == "tts":
+            with Usage() as usage:
+                paths = list(iter_voice_clips(convo, workspace=workspace))
+            output_bytes = sum(os.path.getsize(p) for p in paths if p)
+            detail["failed_lines"] = paths.count(None)
+
+        elif stage == "frames":
+            from draw_image import PROFILE_IMG_SIZE, iter_convo_scroll_frames
+            from gen_profile import contact_avatar, get_initials
+
+            avatar = contact_avatar(get_initials(data["contact_name"]), PROFILE_IMG_SIZE)
+            with Usage() as usage:
+                output_bytes = sum(len(frame.tobytes()) for frame in iter_convo_scroll_frames(
+                    convo, contact_name=data["contact_name"], profile_image=avatar))
+            detail["frames"] = output_bytes // (375 * 667 * 3)
+
+        elif stage == "audio":
+            from audio_mix import AudioEncoder, AudioTimeline, decode_audio, duration_of
+
+            paths = list(iter_voice_clips(convo, workspace=workspace))
+            with Usage() as usage:
+                timeline = AudioTimeline()
+                soundtrack = AudioEncoder(workspace.file("soundtrack.aac"))
+                current_time = 0.0
+                for path, msg in zip(paths, convo):
+                    if path is None:
+                        duration = estimate_speech_duration(msg["text"])
+                    else:
+                        samples = decode_audio(path)
+                        duration = duration_of(samples)
+                        timeline.add(samples, start=current_time)
+                    current_time += duration + PAUSE_SECONDS
+                    soundtrack.write(timeline.drain(current_time))
+                soundtrack.close()
+            output_bytes = os.path.getsize(soundtrack.output_path)
+            detail["audio_seconds"] = round(current_time, 2)
+
+        elif stage == "encode":
+            from draw_image import FRAME_HEIGHT, WIDTH, iter_convo_scroll_frames
+            from encoder import SegmentedEncoder, spread_holds
+            from pipeline import batched
+
+            # Frames are rendered lazily as the encoder needs them; the time
+            # spent rendering is left out so this is the encoder's own cost
+            frames = iter_convo_scroll_frames(convo, contact_name=data["contact_name"])
+            output_path = workspace.file("encoded.mp4")
+            with Usage() as usage:
+                encoder = SegmentedEncoder(os.path.join(workspace.path, "segments"), size=(WIDTH, FRAME_HEIGHT), fps=FPS)
+                current_time = 0.0
+                for msg, message_frames in zip(convo, timed_iter(batched(frames, 5), usage)):
+                    start_time = current_time
+                    current_time += estimate_speech_duration(msg["text"]) + PAUSE_SECONDS
+                    encoder.add(message_frames, spread_holds(len(message_frames), start_time, current_time, FPS))
+                encoder.finish(output_path)
+            output_bytes = os.path.getsize(output_path)
+            detail["video_seconds"] = round(current_time, 2)
+
+        elif stage == "end_to_end":
+            from main import generate_video_from_json
+
+            started = time.perf_counter()
+            stage_done = {}
+            first_segment = {}
+
+            def progress(stage_name, done, total, overall):
+                if done >= total and stage_name not in stage_done:
+                    stage_done[stage_name] = round(time.perf_counter() - started, 3)
+
+            def watch_stream():
+                segment = os.path.join(stream_dir(job_id), "segment_0000.m4s")
+                while "done" not in first_segment:
+                    if os.path.exists(segment):
+                        first_segment["seconds"] = round(time.perf_counter() - started, 3)
+                        return
+                    time.sleep(0.02)
+
+            watcher = threading.Thread(target=watch_stream, daemon=True)
+            watcher.start()
+            # Ask for HLS, which is opt-in, so the first segment can be timed
+            with Usage() as usage:
+                video = generate_video_from_json({**data, "stream": True}, job_id=job_id, progress_callback=progress)
+            first_segment["done"] = True
+            output_bytes = os.path.getsize(video)
+            detail["stage_done_at_s"] = stage_done
+            detail["first_segment_s"] = first_segment.get("seconds")
+            detail["hls_bytes"] = _tree_size(stream_dir(job_id))
+            os.remove(video)
+            shutil.rmtree(stream_dir(job_id), ignore_errors=True)
+
+        elif stage in ("prompt", "prompt_blocking"):
+            from main import generate_video
+
+            # A whole job from a prompt, with the conversation streamed into
+            # rendering or written in full first
+            with Usage() as usage:
+                video = generate_video("A day at work", "light and funny", n_messages, job_id=job_id, stream=stage == "prompt")
+            output_bytes = os.path.getsize(video)
+            os.remove(video)
+            shutil.rmtree(stream_dir(job_id), ignore_errors=True)
+
+        else:
+            raise ValueError(f"Unknown stage {stage!r}")
+
+    return {"scenario": "pipeline", "stage": stage, "messages": n_messages,
+            **usage.result(), "output_bytes": output_bytes, **detail}
+
+
+def run_in_fresh_process(fn, *args):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def start_stub(tts_latency, chat_latency, jitter, rpm=0, error_rate=0.0, tail_rate=0.0, tail_latency=5.0):
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.stub_openai", "--port", "0",
+         "--tts-latency", str(tts_latency), "--chat-latency", str(chat_latency), "--jitter", str(jitter),
+         "--rpm", str(rpm), "--error-rate", str(error_rate), "--tail-rate", str(tail_rate), "--tail-latency", str(tail_latency)],
+        cwd=ROOT, stdout=subprocess.PIPE, text=True,
+    )
+    line = proc.stdout.readline().split()
+    if not line or line[0] != "READY":
+        proc.kill()
+        raise RuntimeError("Stub OpenAI server did not start")
+    return proc, int(line[1])
+
+
+def _http_json(method, url, payload=None, timeout=30):
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def _free_port():
+    import socket
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _peak_rss_mb(pid):
+    # Linux only; VmHWM is the process's resident high-water mark
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def bench_http(server, sizes, seed, timeout=1800):
+    """Submit one job per size to a freshly started server and time it to download."""
+    port = _free_port()
+    env = {**os.environ, "PORT": str(port), "JOB_WORKERS": "1",
+           "JOB_DB_PATH": os.path.join(tempfile.mkdtemp(), "jobs.sqlite3")}
+    if server == "fastapi":
+        cmd = [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"]
+    else:
+        cmd = [sys.executable, "server.py"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    results = []
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                _http_json("GET", base + "/")
+                break
+            except OSError:
+                if time.monotonic() > deadline or proc.poll() is not None:
+                    raise RuntimeError(f"{server} server did not start")
+                time.sleep(0.2)
+
+        for n_messages in sizes:
+            started = time.perf_counter()
+            # Ask for HLS, which is opt-in, so the first segment can be timed
+            job_id = _http_json("POST", base + "/generate", {**bench_request(n_messages, seed), "stream": True})["job_id"]
+            first_segment = None
+            while True:
+                status = _http_json("GET", f"{base}/status/{job_id}")
+                if first_segment is None and status.get("stream_url"):
+                    # The playlist is published empty when rendering starts
+                    with urllib.request.urlopen(base + status["stream_url"], timeout=30) as response:
+                        if b"#EXTINF" in response.read():
+                            first_segment = round(time.perf_counter() - started, 3)
+                if status["status"] in ("completed", "error"):
+                    break
+                if time.perf_counter() - started > timeout:
+                    raise RuntimeError(f"Job {job_id} timed out")
+                time.sleep(0.2)
+            completed = time.perf_counter() - started
+
+            download_started = time.perf_counter()
+            output_bytes = 0
+            if status["status"] == "completed":
+                with urllib.request.urlopen(f"{base}/download/{job_id}", timeout=60) as response:
+                    while chunk := response.read(1 << 20):
+                        output_bytes += len(chunk)
+            results.append({
+                "scenario": "http", "stage": server, "messages": n_messages,
+                "status": status["status"], "error": status.get("error"),
+                "wall_s": round(completed, 3),
+                "first_segment_s": first_segment,
+                "download_s": round(time.perf_counter() - download_started, 3),
+                "output_bytes": output_bytes,
+                "server_peak_rss_mb": _peak_rss_mb(proc.pid),
+            })
+            print(f"[INFO] http {server} {n_messages} messages: {results[-1]['wall_s']}s ({status['status']})")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return results
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r["scenario"], r["stage"], r["messages"]): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {baseline_path}:")
+    print(f"{'scenario':<10}{'stage':<12}{'msgs':>6}{'wall before':>13}{'wall after':>12}{'change':>9}")
+    for r in results:
+        before = baseline.get((r["scenario"], r["stage"], r["messages"]))
+        if not before or not before.get("wall_s"):
+            continue
+        change = (r["wall_s"] - before["wall_s"]) / before["wall_s"] * 100
+        print(f"{r['scenario']:<10}{r['stage']:<12}{r['messages']:>6}{before['wall_s']:>13.2f}{r['wall_s']:>12.2f}{change:>+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="5,20,50,200,500", help="comma-separated conversation lengths")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma-separated subset of {', '.join(STAGES)}")
+    parser.add_argument("--http", default="", help=f"also benchmark these servers: {', '.join(SERVERS)}")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--chat-latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rpm", type=int, default=0, help="stub's requests per minute per endpoint before 429s, 0 for no limit")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of stub requests answered with an injected 429")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="share of stub speech requests that take --tail-latency")
+    parser.add_argument("--tail-latency", type=float, default=5.0)
+    parser.add_argument("--tts-cache", action="store_true", help="keep the TTS cache on (default: every run synthesizes)")
+    parser.add_argument("--output", help="results file (default: output/benchmarks/bench-<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare wall times against")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    stages = [s for s in args.stages.split(",") if s]
+    servers = [s for s in args.http.split(",") if s]
+    for name in stages:
+        if name not in STAGES:
+            parser.error(f"unknown stage {name!r}")
+    for name in servers:
+        if name not in SERVERS:
+            parser.error(f"unknown server {name!r}")
+
+    stub, stub_port = start_stub(
+        args.tts_latency, args.chat_latency, args.jitter,
+        rpm=args.rpm, error_rate=args.error_rate, tail_rate=args.tail_rate, tail_latency=args.tail_latency,
+    )
+    # Inherited by every worker and server process started from here on
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{stub_port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    if not args.tts_cache:
+        os.environ["TTS_CACHE_MAX_BYTES"] = "0"
+
+    results = []
+    try:
+        for n_messages in sizes:
+            for stage in stages:
+                for run in range(args.repeat):
+                    result = run_in_fresh_process(measure_stage, stage, n_messages, args.seed + run)
+                    result["run"] = run
+                    results.append(result)
+                    print(f"[INFO] {stage} {n_messages} messages: {result['wall_s']}s wall, "
+                          f"{result['cpu_s']}s CPU, {result['peak_rss_mb']} MB peak RSS")
+        for server in servers:
+            for run in range(args.repeat):
+                for result in bench_http(server, sizes, seed=args.seed + 1000 + run):
+                    result["run"] = run
+                    results.append(result)
+        stub_stats = _http_json("GET", f"http://127.0.0.1:{stub_port}/stats")
+    finally:
+        stub.terminate()
+
+    output = args.output or os.path.join(ROOT, "output", "benchmarks", f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"meta": metadata(args), "stub": stub_stats, "results": results}, f, indent=2)
+    print(f"[INFO] Wrote {len(results)} results to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
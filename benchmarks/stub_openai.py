@@ -0,0 +1,278 @@
+"""Local stand-in for the parts of the OpenAI API the service uses.
+
+Serves POST /v1/audio/speech with canned MP3s and POST /v1/chat/completions
+with a synthetic conversation, each after a configurable delay (a streamed
+chat reply is spread over it), so the pipeline can be measured offline and
+without a key. It can also enforce a per-minute request limit, inject 429s
+and make some speech requests slow, with OpenAI's rate-limit headers on
+every reply. GET /stats reports request counts and the peak number of
+requests in flight.
+
+    python -m benchmarks.stub_openai --port 8765 --tts-latency 0.3
+
+Prints "READY <port>" once it is listening.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import imageio_ffmpeg
+
+# Characters per streamed chat chunk, about one token's worth
+STREAM_CHUNK_CHARS = 4
+
+WORDS = (
+    "hey lol ok sure honestly that is wild cannot believe you did that again "
+    "tomorrow maybe pizza later coding is fun wait what no way seriously"
+).split()
+
+
+class CannedAudio:
+    """Quiet MP3 tones, made once per length and reused.
+
+    Lengths follow the text like real speech does, about 2.5 words a second,
+    rounded to half a second so a handful of files covers every line.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._cache = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def for_text(self, text):
+        seconds = min(15.0, max(0.5, round(len(text.split()) / 2.5 * 2) / 2))
+        with self._lock:
+            if seconds not in self._cache:
+                self._cache[seconds] = self._make(seconds)
+            return self._cache[seconds]
+
+    def _make(self, seconds):
+        path = os.path.join(self.directory, f"tone_{seconds:.1f}.mp3")
+        if not os.path.exists(path):
+            subprocess.run([
+                imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+                "-f", "lavfi", "-i", f"sine=frequency=220:duration={seconds}",
+                "-af", "volume=0.2", "-ac", "1", "-ar", "24000", "-b:a", "64k", path,
+            ], check=True)
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def fake_conversation(n_messages, names=("Alice", "You"), seed=0):
+    rng = random.Random(seed)
+    return [
+        {"sender": names[i % 2], "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 25)))}
+        for i in range(n_messages)
+    ]
+
+
+class StubOpenAI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tts_latency=0.3, chat_latency=1.0, jitter=0.0, audio_dir=None,
+                 rpm=0, error_rate=0.0, tail_rate=0.0, tail_latency=5.0):
+        super().__init__(address, StubHandler)
+        self.tts_latency = tts_latency
+        self.chat_latency = chat_latency
+        self.jitter = jitter
+        self.audio = CannedAudio(audio_dir or os.path.join(tempfile.gettempdir(), "stub_openai_audio"))
+        # Requests per minute before answering 429, like an account's limit
+        self.rpm = rpm
+        # Share of requests answered with a 429 regardless of the limit
+        self.error_rate = error_rate
+        # Share of speech requests that take tail_latency instead
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.counts = {"speech": 0, "chat": 0, "rate_limited": 0}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._quota = {}
+        self._lock = threading.Lock()
+
+    def delay(self, base):
+        time.sleep(max(0.0, base + random.uniform(-self.jitter, self.jitter)))
+
+    def speech_delay(self):
+        if random.random() < self.tail_rate:
+            return self.tail_latency
+        return self.tts_latency
+
+    def admit(self, kind):
+        """Take a request from the endpoint's quota; returns (allowed, headers).
+
+        Like OpenAI's, the quota is a bucket of `rpm` requests that refills
+        continuously. The headers are its x-ratelimit-* request headers,
+        plus retry-after-ms on a 429. Without a limit only injected 429s
+        happen.
+        """
+        now = time.monotonic()
+        limit = self.rpm or 10000
+        with self._lock:
+            last, tokens = self._quota.get(kind, (now, limit))
+            tokens = min(limit, tokens + (now - last) * limit / 60)
+            limited = tokens < 1 or random.random() < self.error_rate
+            if limited:
+                self.counts["rate_limited"] += 1
+            else:
+                tokens -= 1
+            self._quota[kind] = (now, tokens)
+        headers = {
+            "x-ratelimit-limit-requests": str(limit),
+            "x-ratelimit-remaining-requests": str(int(tokens)),
+            "x-ratelimit-reset-requests": f"{(limit - tokens) * 60 / limit:.3f}s",
+        }
+        if limited:
+            headers["retry-after-ms"] = str(max(1, round((1 - tokens % 1) * 60 / limit * 1000)))
+        return not limited, headers
+
+    def begin(self, kind):
+        with self._lock:
+            self.counts[kind] += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"requests": dict(self.counts), "in_flight": self.in_flight, "peak_in_flight": self.peak_in_flight}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._rate_headers = {}
+        if self.path.rstrip("/") == "/stats":
+            self._send(200, json.dumps(self.server.stats()).encode(), "application/json")
+        else:
+            self._send(404, b'{"error": "not found"}', "application/json")
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self._rate_headers = {}
+        kind = "speech" if self.path.endswith("/audio/speech") else "chat" if self.path.endswith("/chat/completions") else None
+        if kind is None:
+            self._send(404, b'{"error": {"message": "not found"}}', "application/json")
+            return
+        allowed, self._rate_headers = self.server.admit(kind)
+        if not allowed:
+            error = {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}}
+            self._send(429, json.dumps(error).encode(), "application/json")
+            return
+        self.server.begin(kind)
+        try:
+            if kind == "speech":
+                self.server.delay(self.server.speech_delay())
+                self._send(200, self.server.audio.for_text(body.get("input", "")), "audio/mpeg")
+            elif body.get("stream"):
+                self._stream_chat_completion(body)
+            else:
+                self.server.delay(self.server.chat_latency)
+                self._send(200, json.dumps(self._chat_completion(body)).encode(), "application/json")
+        finally:
+            self.server.end()
+
+    def _chat_completion(self, body):
+        prompt = " ".join(m.get("content", "") for m in body.get("messages", []))
+        match = re.search(r"with (\d+) messages", prompt)
+        names = re.search(r"between two people named (\w+) and (\w+)", prompt)
+        convo = fake_conversation(
+            int(match.group(1)) if match else 10,
+            names=names.groups() if names else ("Alice", "You"),
+        )
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-3.5-turbo"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": json.dumps(convo)},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    def _stream_chat_completion(self, body):
+        # The reply goes out as server-sent events a few characters at a
+        # time, spread over the chat latency like tokens from a real model
+        content = self._chat_completion(body)["choices"][0]["message"]["content"]
+        pieces = [content[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(content), STREAM_CHUNK_CHARS)]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        for name, value in self._rate_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.close_connection = True
+        started = time.perf_counter()
+        total = max(0.0, self.server.chat_latency + random.uniform(-self.server.jitter, self.server.jitter))
+        for k, piece in enumerate(pieces + [None]):
+            time.sleep(max(0.0, started + total * k / len(pieces) - time.perf_counter()))
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "gpt-3.5-turbo"),
+                "choices": [{
+                    "index": 0,
+                    "delta": {"content": piece} if piece is not None else {},
+                    "finish_reason": None if piece is not None else "stop",
+                }],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _send(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in self._rate_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--tts-latency", type=float, default=0.3, help="seconds per speech request")
+    parser.add_argument("--chat-latency", type=float, default=1.0, help="seconds per chat request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds added to each delay")
+    parser.add_argument("--audio-dir", help="where canned MP3s are kept")
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute per endpoint before answering 429, 0 for no limit")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with an injected 429")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="share of speech requests that take --tail-latency")
+    parser.add_argument("--tail-latency", type=float, default=5.0, help="seconds a slow speech request takes")
+    args = parser.parse_args()
+
+    server = StubOpenAI(
+        (args.host, args.port), tts_latency=args.tts_latency, chat_latency=args.chat_latency,
+        jitter=args.jitter, audio_dir=args.audio_dir, rpm=args.rpm, error_rate=args.error_rate,
+        tail_rate=args.tail_rate, tail_latency=args.tail_latency,
+    )
+    print(f"READY {server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import threading
+
+CHECKPOINT_NAME = "checkpoint.json"
+
+
+class Checkpoint:
+    """Durable record of what a job has finished, kept in its workspace.
+
+    Each stage's result (a path, a list of timings, a map of lines) is
+    stored under the stage's name in one small JSON manifest; the artifacts
+    themselves are files next to it. The manifest is rewritten through a
+    temp file and a rename on save(), so a crash leaves the previous version
+    intact. Items saved one at a time with save_item() are appended to a log
+    next to it instead, so a long conversation doesn't rewrite the manifest
+    for every line; the next save() folds them in. Both are only trusted
+    when their `key` matches the one the job runs with, so a workspace left
+    by a different request or an older renderer starts over. Safe to update
+    from several threads.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.log_path = f"{path}.log"
+        self.key = key
+        self._lock = threading.Lock()
+        self._log = None
+        self._stages = self._load()
+
+    def get(self, stage, default=None):
+        with self._lock:
+            return self._stages.get(stage, default)
+
+    def save(self, **stages):
+        """Record one or more finished stages in a single write."""
+        with self._lock:
+            self._stages.update(stages)
+            self._write()
+
+    def save_item(self, stage, key, value):
+        """Record one item of a stage that finishes piece by piece, such as a voice line."""
+        with self._lock:
+            self._stages.setdefault(stage, {})[str(key)] = value
+            if self._log is None:
+                self._log = open(self.log_path, "a", encoding="utf-8")
+            # Each record starts on a new line, so one cut short by a crash
+            # can't swallow the next
+            self._log.write("\n" + json.dumps({"key": self.key, "stage": stage, "item": str(key), "value": value}, ensure_ascii=False))
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+    def reset(self):
+        with self._lock:
+            if self._stages:
+                self._stages = {}
+                self._write()
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def _load(self):
+        stages = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("key") == self.key:
+                stages = manifest.get("stages", {})
+        except (FileNotFoundError, ValueError):
+            pass
+        try:
+            with open(self.log_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # blank, or cut short by a crash
+                    if record.get("key") == self.key:
+                        stages.setdefault(record["stage"], {})[record["item"]] = record["value"]
+        except FileNotFoundError:
+            pass
+        return stages
+
+    def _write(self):
+        # Caller holds self._lock. The manifest now holds everything in the
+        # log, so the log starts over.
+        write_json(self.path, {"key": self.key, "stages": self._stages})
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        try:
+            os.remove(self.log_path)
+        except FileNotFoundError:
+            pass
+
+
+def checkpoint_key(*parts):
+    """A stable hash of everything a job's checkpointed artifacts depend on."""
+    encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def write_json(path, value):
+    """Write `value` to `path` as JSON, all at once or not at all."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(value, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,120 @@
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from workspace import VIDEO_TTL_SECONDS
+
+# Finished videos never change under the same URL, so caches can keep them
+# for as long as the origin does
+DOWNLOAD_CACHE_CONTROL = f"public, max-age={VIDEO_TTL_SECONDS}"
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def file_etag(st):
+    """Strong validator for a published video.
+
+    Videos are written to a temporary name and renamed into place, but the
+    inode of an evicted video can be handed to a later one of the same size,
+    so the modification time is part of the tag too. Touching the file to
+    mark it recently used (which the result cache does) changes it as well;
+    that costs a client a full download, never a mixed-up one.
+    """
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """The (start, end) byte span, end inclusive, asked for by a Range header.
+
+    Returns None when the whole file should be sent (no header, a unit or
+    syntax we don't handle, or several ranges at once) and "unsatisfiable"
+    when the span lies outside the file.
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            return "unsatisfiable"
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        return "unsatisfiable"
+    return start, min(end, size - 1)
+
+
+def plan_download(path, request_headers, filename=None, cache_control=DOWNLOAD_CACHE_CONTROL):
+    """Work out the response to a GET for `path` from the request's headers.
+
+    Handles If-None-Match / If-Modified-Since (304), Range and If-Range
+    (206 or 416). Returns (status, headers, span) where span is the
+    (start, end) of the body to send, inclusive, or None for no body.
+    `request_headers` is any case-insensitive mapping.
+    """
+    st = os.stat(path)
+    etag = file_etag(st)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    if filename:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        if _etag_matches(if_none_match, etag, weak=True):
+            return 304, headers, None
+    elif _not_modified_since(request_headers.get("if-modified-since"), st.st_mtime):
+        return 304, headers, None
+
+    size = st.st_size
+    span = parse_range(request_headers.get("range"), size)
+    if_range = request_headers.get("if-range")
+    if span is not None and if_range is not None and not _etag_matches(if_range, etag, weak=False):
+        # The client's partial copy is of an older file; send all of this one
+        span = None
+
+    if span == "unsatisfiable":
+        headers["Content-Range"] = f"bytes */{size}"
+        headers["Content-Length"] = "0"
+        return 416, headers, None
+    if span is None:
+        headers["Content-Length"] = str(size)
+        return 200, headers, (0, size - 1) if size else None
+    start, end = span
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return 206, headers, span
+
+
+def _etag_matches(header, etag, weak):
+    if header.strip() == "*":
+        return True
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _not_modified_since(header, mtime):
+    if not header:
+        return False
+    try:
+        since = parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return int(mtime) <= since
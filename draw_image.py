@@ -1,4 +1,6 @@
 from PIL import Image, ImageDraw, ImageFont, ImageOps
+from collections import namedtuple
+from functools import lru_cache
 import textwrap
 import os
 import platform
@@ -17,6 +19,14 @@ PADDING = 20
 BUBBLE_PADDING = 10
 FONT_SIZE = 18
 PROFILE_IMG_SIZE = 50
+HEADER_FONT_SIZE = 20
+WRAP_WIDTH = 30  # characters per bubble line
+# "page" clears the screen when it fills up; "scroll" scrolls one tall
+# canvas like a chat app does
+SCROLL_MODES = ("page", "scroll")
+SCROLL_MODE = os.getenv("SCROLL_MODE", "page")
+# Message layouts remembered per process; conversations repeat short lines a lot
+TEXT_LAYOUT_CACHE_SIZE = int(os.getenv("TEXT_LAYOUT_CACHE_SIZE", 4096))
 
 # Dark mode colors
 BACKGROUND_COLOR = "#121212"  # Dark background
@@ -35,22 +45,33 @@ elif platform.system() == "Windows":
 else:  # Linux and others
     FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
 
-# Verify font exists
-if not os.path.exists(FONT_PATH):
-    # Fallback fonts for macOS
-    fallback_fonts = [
-        "/System/Library/Fonts/SFNSText.ttf",
-        "/System/Library/Fonts/SFNSDisplay.ttf",
-        "/System/Library/Fonts/AppleSDGothicNeo.ttc",
-        "/Library/Fonts/Arial.ttf"
-    ]
-
-    for font in fallback_fonts:
-        if os.path.exists(font):
-            FONT_PATH = font
-            break
-    else:
-        raise FileNotFoundError(f"Could not find any suitable font. Please install a TrueType font.")
+# Fallback fonts for macOS
+FALLBACK_FONTS = [
+    "/System/Library/Fonts/SFNSText.ttf",
+    "/System/Library/Fonts/SFNSDisplay.ttf",
+    "/System/Library/Fonts/AppleSDGothicNeo.ttc",
+    "/Library/Fonts/Arial.ttf"
+]
+
+# Wrapped lines of one message and the size of the bubble around them
+MessageLayout = namedtuple("MessageLayout", ["lines", "line_widths", "bubble_width", "bubble_height"])
+
+
+@lru_cache(maxsize=None)
+def resolve_font_path(path=None):
+    """The font file to use: `path`, else FONT_PATH, else the first fallback that exists.
+
+    Looked up on first use rather than at import, and remembered.
+    """
+    for candidate in [path or FONT_PATH] + FALLBACK_FONTS:
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(f"Could not find any suitable font. Please install a TrueType font.")
+
+@lru_cache(maxsize=None)
+def get_font(size=FONT_SIZE, path=None):
+    """Process-wide registry of loaded fonts; each face and size is read from disk once."""
+    return ImageFont.truetype(resolve_font_path(path), size)
 
 def get_text_width(font, text):
     bbox = font.getbbox(text)
@@ -59,6 +80,15 @@ def get_text_width(font, text):
 def get_text_height(lines):
     return len(lines) * (FONT_SIZE + 5) + BUBBLE_PADDING
 
+@lru_cache(maxsize=TEXT_LAYOUT_CACHE_SIZE)
+def layout_message(text, size=FONT_SIZE, path=None):
+    """Wrap and measure a message's text once; every frame showing it reuses the result."""
+    font = get_font(size, path)
+    lines = tuple(textwrap.wrap(text, width=WRAP_WIDTH))
+    line_widths = tuple(get_text_width(font, line) for line in lines)
+    bubble_width = max(line_widths, default=0) + 2 * BUBBLE_PADDING
+    return MessageLayout(lines, line_widths, bubble_width, get_text_height(lines))
+
 def draw_ios_bubble_with_curve(draw, x0, y0, x1, y1, fill, is_user=False):
     """Draw an iOS-style bubble with a smooth curve from the edge to a point outside."""
     # Basic bubble parameters
@@ -68,17 +98,28 @@ def draw_ios_bubble_with_curve(draw, x0, y0, x1, y1, fill, is_user=False):
     draw.rounded_rectangle([x0, y0, x1, y1], radius=20, fill=fill)
 
 
-def render_messages_to_frame(messages, font, contact_name="Contact", profile_image_path=None):
-    total_height = HEADER_HEIGHT + PADDING
-    message_boxes = []
+def load_profile_image(profile_image_path):
+    """Open, resize and circle-mask the header avatar once so every frame can reuse it."""
+    if not (profile_image_path and os.path.exists(profile_image_path)):
+        return None
+    return prepare_profile_image(Image.open(profile_image_path))
 
-    for msg in messages:
-        lines = textwrap.wrap(msg["text"], width=30)
-        height = get_text_height(lines) + 10  # spacing
-        message_boxes.append((msg, lines, height))
-        total_height += height
+def prepare_profile_image(profile_img):
+    """(avatar, circular mask) for the header from any image; one already at header size is used as is."""
+    profile_img = profile_img.convert("RGB")
+    if profile_img.size != (PROFILE_IMG_SIZE, PROFILE_IMG_SIZE):
+        profile_img = profile_img.resize((PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), RESAMPLING)
+
+    # Create circular mask
+    mask = Image.new("L", (PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), 0)
+    draw_mask = ImageDraw.Draw(mask)
+    draw_mask.ellipse((0, 0, PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), fill=255)
+
+    profile_img = ImageOps.fit(profile_img, (PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), centering=(0.5, 0.5))
+    return profile_img, mask
 
-    # Create image with dark background
+def render_header_canvas(contact_name, header_font, profile=None):
+    """Blank frame with only the header drawn; the base canvas every page starts from."""
     img = Image.new("RGB", (WIDTH, FRAME_HEIGHT), color=BACKGROUND_COLOR)
     draw = ImageDraw.Draw(img)
 
@@ -86,140 +127,205 @@ def render_messages_to_frame(messages, font, contact_name="Contact", profile_ima
     draw.rectangle([0, 0, WIDTH, HEADER_HEIGHT], fill=HEADER_BG_COLOR)
 
     # Draw profile picture (centered circle)
-    if profile_image_path and os.path.exists(profile_image_path):
-        profile_img = Image.open(profile_image_path).convert("RGB")
-        profile_img = profile_img.resize((PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), RESAMPLING)
-
-        # Create circular mask
-        mask = Image.new("L", (PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), 0)
-        draw_mask = ImageDraw.Draw(mask)
-        draw_mask.ellipse((0, 0, PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), fill=255)
-
-        # Apply mask and paste centered
-        profile_img = ImageOps.fit(profile_img, (PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), centering=(0.5, 0.5))
+    if profile is not None:
+        profile_img, mask = profile
         img.paste(profile_img, ((WIDTH - PROFILE_IMG_SIZE) // 2, 10), mask)
 
     # Draw contact name below the image with dark mode text color
-    header_font = ImageFont.truetype(FONT_PATH, 20)
     text_width = get_text_width(header_font, contact_name)
     draw.text(((WIDTH - text_width) / 2, 10 + PROFILE_IMG_SIZE + 5), contact_name, font=header_font, fill=HEADER_TEXT_COLOR)
 
-    # Draw messages starting below header
-    y = HEADER_HEIGHT + PADDING
-    for msg, lines, _ in message_boxes:
-        is_user = msg["sender"] == "You"
-        bubble_color = USER_BUBBLE_COLOR if is_user else OTHER_BUBBLE_COLOR
-        text_color = USER_TEXT_COLOR if is_user else OTHER_TEXT_COLOR
+    return img
 
-        bubble_width = max([get_text_width(font, line) for line in lines]) + 2 * BUBBLE_PADDING
-        bubble_height = get_text_height(lines)
+def draw_message_bubble(draw, msg, layout, y, font, x0=None):
+    """Draw one message bubble with its top edge at y and return the bubble height.
 
+    `layout` is the message's MessageLayout from layout_message().
+    """
+    is_user = msg["sender"] == "You"
+    bubble_color = USER_BUBBLE_COLOR if is_user else OTHER_BUBBLE_COLOR
+    text_color = USER_TEXT_COLOR if is_user else OTHER_TEXT_COLOR
+
+    lines = layout.lines
+    bubble_width = layout.bubble_width
+    bubble_height = layout.bubble_height
+
+    if x0 is None:
         x0 = WIDTH - bubble_width - PADDING if is_user else PADDING
-        y0 = y
-        x1 = x0 + bubble_width
-        y1 = y0 + bubble_height
+    x1 = x0 + bubble_width
+    y1 = y + bubble_height
 
-        # Use the iOS bubble with curve function
-        draw_ios_bubble_with_curve(draw, x0, y0, x1, y1, bubble_color, is_user)
+    # Use the iOS bubble with curve function
+    draw_ios_bubble_with_curve(draw, x0, y, x1, y1, bubble_color, is_user)
 
-        text_y = y0 + BUBBLE_PADDING // 2
-        for line in lines:
-            draw.text((x0 + BUBBLE_PADDING, text_y), line, font=font, fill=text_color)
-            text_y += FONT_SIZE + 5
+    text_y = y + BUBBLE_PADDING // 2
+    for line in lines:
+        draw.text((x0 + BUBBLE_PADDING, text_y), line, font=font, fill=text_color)
+        text_y += FONT_SIZE + 5
 
-        y = y1 + 10
+    return bubble_height
 
-    return img
+def render_bubble_tile(msg, layout, font):
+    """Draw a message's bubble once on a transparent tile to paste into every frame.
 
-def draw_convo_scroll_frames(convo, contact_name="Contact", profile_image_path=None, output_dir=None, num_transition_frames=5):
-    if output_dir is None:
-        base_dir = os.path.dirname(__file__)
-        output_dir = os.path.join(base_dir, "output", "frames")
+    Rasterizing the text is most of the cost of a frame, and each bubble is
+    shown in several transition frames and then settled onto the page.
+    Returns (tile, x) where x is the tile's left edge in the frame.
+    """
+    tile = Image.new("RGBA", (layout.bubble_width + 1, layout.bubble_height + 1), (0, 0, 0, 0))
+    draw_message_bubble(ImageDraw.Draw(tile), msg, layout, 0, font, x0=0)
+    is_user = msg["sender"] == "You"
+    x0 = WIDTH - layout.bubble_width - PADDING if is_user else PADDING
+    return tile, x0
 
-    os.makedirs(output_dir, exist_ok=True)
-    font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
 
-    frames = []
-    visible_msgs = []
+def render_messages_to_frame(messages, font, contact_name="Contact", profile_image_path=None):
+    header_font = get_font(HEADER_FONT_SIZE)
+    img = render_header_canvas(contact_name, header_font, load_profile_image(profile_image_path))
+    draw = ImageDraw.Draw(img)
+
+    # Draw messages starting below header
+    y = HEADER_HEIGHT + PADDING
+    for msg in messages:
+        layout = layout_message(msg["text"], font.size, font.path)
+        y += draw_message_bubble(draw, msg, layout, y, font) + 10
+
+    return img
+
+def iter_convo_scroll_frames(convo, contact_name="Contact", profile_image_path=None, num_transition_frames=5, profile_image=None, mode=None, start=0):
+    """Yield every transition frame as a PIL image, in order, without touching disk.
+
+    The header avatar is `profile_image`, an image (ideally already
+    PROFILE_IMG_SIZE square), or else read from `profile_image_path`.
+    `mode` is one of SCROLL_MODES (default SCROLL_MODE); "scroll" hands over
+    to iter_convo_viewport_frames. Messages before `start` are laid out but
+    their frames aren't drawn: None stands in for each, for a caller that
+    already has them encoded.
+
+    Only the current page canvas and the frames the consumer holds on to are
+    alive at any time, so memory stays flat however long the conversation is.
+    Every frame is a new image that later iterations never touch, so it is safe
+    to keep or hand to another thread.
+    """
+    mode = mode or SCROLL_MODE
+    if mode == "scroll":
+        yield from iter_convo_viewport_frames(convo, contact_name, profile_image_path, num_transition_frames, profile_image, start)
+        return
+    if mode != "page":
+        raise ValueError(f"Unknown scroll mode {mode!r}, expected one of {', '.join(SCROLL_MODES)}")
+
+    font = get_font(FONT_SIZE)
+    # Every page starts from the same header
+    header_canvas = render_header_canvas(contact_name, get_font(HEADER_FONT_SIZE), _header_profile(profile_image, profile_image_path))
+
+    # Header plus every settled bubble of the current page. Each transition
+    # frame is a copy of this canvas with only the sliding bubble drawn on top.
+    page_canvas = None
     cumulative_height = HEADER_HEIGHT + PADDING
 
     for i, msg in enumerate(convo):
-        lines = textwrap.wrap(msg["text"], width=30)
-        msg_height = get_text_height(lines) + 10
+        layout = layout_message(msg["text"])
+        msg_height = layout.bubble_height + 10
         new_height = cumulative_height + msg_height
 
         # If adding the next message exceeds the screen, reset to top
-        if new_height > FRAME_HEIGHT:
-            visible_msgs = []
+        if page_canvas is None or new_height > FRAME_HEIGHT:
+            page_canvas = header_canvas.copy()
             cumulative_height = HEADER_HEIGHT + PADDING
 
-        visible_msgs.append(msg)
+        # The new message slides up from below into its resting position
+        y_position = cumulative_height
         cumulative_height += msg_height
+        tile, x0 = render_bubble_tile(msg, layout, font)
 
-        # Calculate where the new message will appear (slide from below)
-        y_position = HEADER_HEIGHT + PADDING
-        for m in visible_msgs[:-1]:
-            y_position += get_text_height(textwrap.wrap(m["text"], width=30)) + 10
+        if i < start:
+            yield from [None] * num_transition_frames
+            page_canvas.paste(tile, (x0, y_position), tile)
+            continue
 
         for j in range(1, num_transition_frames + 1):
-            temp_img = Image.new("RGB", (WIDTH, FRAME_HEIGHT), color=BACKGROUND_COLOR)
-            draw = ImageDraw.Draw(temp_img)
-
-            # Draw header
-            draw.rectangle([0, 0, WIDTH, HEADER_HEIGHT], fill=HEADER_BG_COLOR)
-            if profile_image_path and os.path.exists(profile_image_path):
-                profile_img = Image.open(profile_image_path).convert("RGB")
-                profile_img = profile_img.resize((PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), RESAMPLING)
-                mask = Image.new("L", (PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), 0)
-                draw_mask = ImageDraw.Draw(mask)
-                draw_mask.ellipse((0, 0, PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), fill=255)
-                profile_img = ImageOps.fit(profile_img, (PROFILE_IMG_SIZE, PROFILE_IMG_SIZE), centering=(0.5, 0.5))
-                temp_img.paste(profile_img, ((WIDTH - PROFILE_IMG_SIZE) // 2, 10), mask)
-
-            header_font = ImageFont.truetype(FONT_PATH, 20)
-            text_width = get_text_width(header_font, contact_name)
-            draw.text(((WIDTH - text_width) / 2, 10 + PROFILE_IMG_SIZE + 5), contact_name, font=header_font, fill=HEADER_TEXT_COLOR)
-
-            # Draw old messages
-            y = HEADER_HEIGHT + PADDING
-            for m in visible_msgs[:-1]:
-                lines = textwrap.wrap(m["text"], width=30)
-                is_user = m["sender"] == "You"
-                bubble_color = USER_BUBBLE_COLOR if is_user else OTHER_BUBBLE_COLOR
-                text_color = USER_TEXT_COLOR if is_user else OTHER_TEXT_COLOR
-                bubble_width = max([get_text_width(font, line) for line in lines]) + 2 * BUBBLE_PADDING
-                bubble_height = get_text_height(lines)
-                x0 = WIDTH - bubble_width - PADDING if is_user else PADDING
-                x1 = x0 + bubble_width
-                y1 = y + bubble_height
-                draw_ios_bubble_with_curve(draw, x0, y, x1, y1, bubble_color, is_user)
-                text_y = y + BUBBLE_PADDING // 2
-                for line in lines:
-                    draw.text((x0 + BUBBLE_PADDING, text_y), line, font=font, fill=text_color)
-                    text_y += FONT_SIZE + 5
-                y += bubble_height + 10
-
-            # Slide-in new message
             slide_progress = j / num_transition_frames
             slide_y_offset = int((1 - slide_progress) * 50)
-            lines = textwrap.wrap(msg["text"], width=30)
-            is_user = msg["sender"] == "You"
-            bubble_color = USER_BUBBLE_COLOR if is_user else OTHER_BUBBLE_COLOR
-            text_color = USER_TEXT_COLOR if is_user else OTHER_TEXT_COLOR
-            bubble_width = max([get_text_width(font, line) for line in lines]) + 2 * BUBBLE_PADDING
-            bubble_height = get_text_height(lines)
-            x0 = WIDTH - bubble_width - PADDING if is_user else PADDING
-            x1 = x0 + bubble_width
-            y0 = y_position + slide_y_offset
-            y1 = y0 + bubble_height
-            draw_ios_bubble_with_curve(draw, x0, y0, x1, y1, bubble_color, is_user)
-            text_y = y0 + BUBBLE_PADDING // 2
-            for line in lines:
-                draw.text((x0 + BUBBLE_PADDING, text_y), line, font=font, fill=text_color)
-                text_y += FONT_SIZE + 5
-
-            frame_path = os.path.join(output_dir, f"frame_{len(frames):03}.png")
-            temp_img.save(frame_path)
-            frames.append(frame_path)
+
+            temp_img = page_canvas.copy()
+            temp_img.paste(tile, (x0, y_position + slide_y_offset), tile)
+            yield temp_img
+
+        # Settle the bubble onto the page so later frames don't redraw it
+        page_canvas.paste(tile, (x0, y_position), tile)
+
+def iter_convo_viewport_frames(convo, contact_name="Contact", profile_image_path=None, num_transition_frames=5, profile_image=None, start=0):
+    """Yield transition frames as views of one tall canvas that scrolls like a chat app.
+
+    Bubbles are stacked on a canvas that doubles in height whenever the
+    next one doesn't fit, so `convo` may still be arriving. Each new message
+    slides in while the view eases down just far enough to show it, and each
+    frame is a crop of the canvas at that scroll offset with the header
+    pasted on top, so a frame costs the same however many bubbles are on
+    screen. The canvas holds 40 to 80 MB for 500 messages. As in
+    iter_convo_scroll_frames, messages before `start` yield None frames.
+    """
+    font = get_font(FONT_SIZE)
+    header = render_header_canvas(
+        contact_name, get_font(HEADER_FONT_SIZE), _header_profile(profile_image, profile_image_path)
+    ).crop((0, 0, WIDTH, HEADER_HEIGHT))
+    view_height = FRAME_HEIGHT - HEADER_HEIGHT
+
+    # Canvas coordinates start just below the header
+    canvas = Image.new("RGB", (WIDTH, view_height), color=BACKGROUND_COLOR)
+    y = PADDING
+
+    offset = 0
+    for i, msg in enumerate(convo):
+        layout = layout_message(msg["text"])
+        top = y
+        y += layout.bubble_height + 10
+        if y + PADDING > canvas.height:
+            grown = Image.new("RGB", (WIDTH, max(y + PADDING, canvas.height * 2)), color=BACKGROUND_COLOR)
+            grown.paste(canvas, (0, 0))
+            canvas = grown
+        tile, x0 = render_bubble_tile(msg, layout, font)
+        # Scroll only as far as it takes to show the new bubble, never back up
+        origin = offset
+        target = max(offset, top + layout.bubble_height + PADDING - view_height)
+
+        if i < start:
+            yield from [None] * num_transition_frames
+            offset = target
+            canvas.paste(tile, (x0, top), tile)
+            continue
+
+        for j in range(1, num_transition_frames + 1):
+            progress = j / num_transition_frames
+            offset = origin + round((target - origin) * (1 - (1 - progress) ** 2))  # ease out
+            slide_y_offset = int((1 - progress) * 50)
+
+            # Rows above the canvas come back black; the header covers them
+            frame = canvas.crop((0, offset - HEADER_HEIGHT, WIDTH, offset + view_height))
+            frame.paste(tile, (x0, HEADER_HEIGHT + top - offset + slide_y_offset), tile)
+            frame.paste(header, (0, 0))
+            yield frame
+
+        canvas.paste(tile, (x0, top), tile)
+
+def _header_profile(profile_image, profile_image_path):
+    if profile_image is not None:
+        return prepare_profile_image(profile_image)
+    return load_profile_image(profile_image_path)
+
+def draw_convo_scroll_frames(convo, contact_name="Contact", profile_image_path=None, output_dir=None, num_transition_frames=5, workspace=None, mode=None):
+    if output_dir is None and workspace is not None:
+        output_dir = workspace.frames_dir
+    elif output_dir is None:
+        base_dir = os.path.dirname(__file__)
+        output_dir = os.path.join(base_dir, "output", "frames")
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    frames = []
+    for temp_img in iter_convo_scroll_frames(convo, contact_name, profile_image_path, num_transition_frames, mode=mode):
+        frame_path = os.path.join(output_dir, f"frame_{len(frames):03}.png")
+        temp_img.save(frame_path)
+        frames.append(frame_path)
 
     return frames
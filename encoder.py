@@ -0,0 +1,288 @@
+import os
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import imageio_ffmpeg
+from metrics import metrics
+
+# Encoder knobs, overridable per deployment
+VIDEO_PRESET = os.environ.get("VIDEO_PRESET", "medium")
+VIDEO_CRF = int(os.environ.get("VIDEO_CRF", 23))
+VIDEO_THREADS = int(os.environ.get("VIDEO_THREADS", 0))  # 0 lets x264 pick
+# Pipelined jobs encode the video in pieces of this many seconds, each one as
+# soon as its frames and timing are known
+VIDEO_SEGMENT_SECONDS = float(os.environ.get("VIDEO_SEGMENT_SECONDS", 4))
+# Preview (draft) renders: output scale, frame rate and x264 preset
+PREVIEW_SCALE = float(os.environ.get("PREVIEW_SCALE", 0.5))
+PREVIEW_FPS = int(os.environ.get("PREVIEW_FPS", 12))
+PREVIEW_PRESET = os.environ.get("PREVIEW_PRESET", "ultrafast")
+PREVIEW_SEGMENT_SECONDS = 30
+
+
+def get_ffmpeg_exe():
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+def preview_size(size):
+    """`size` scaled by PREVIEW_SCALE, rounded to even numbers as x264 needs."""
+    return tuple(max(2, round(side * PREVIEW_SCALE / 2) * 2) for side in size)
+
+
+def hold_timeline_filter(holds, fps=24):
+    """Build a setpts filter that places input frame N at the start of its hold.
+
+    Frames arrive at a nominal `fps`, one per distinct image. Frame k must
+    stay on screen for holds[k] output frames, so its timestamp is the sum of
+    the holds before it. One extra copy of the last frame is expected at the
+    very end so the final hold has an end timestamp.
+    """
+    terms = ["N"]
+    for k, hold in enumerate(holds):
+        if hold > 1:
+            terms.append(f"gte(N,{k + 1})*{hold - 1}")
+    expr = "+".join(terms) + f"-gte(N,{len(holds)})"
+    return f"setpts='({expr})/({fps}*TB)'"
+
+
+def spread_holds(frame_count, start_time, end_time, fps=24):
+    """Spread start_time..end_time (seconds) over `frame_count` images as holds.
+
+    Returns how many output frames each image stays on screen. Both ends
+    are rounded from the running time rather than from the span's length,
+    so consecutive spans never let the picture drift away from the audio.
+    """
+    start_frame = round(start_time * fps)
+    shown = round(end_time * fps) - start_frame
+    holds = [0] * frame_count
+    for frame in range(shown):
+        holds[int(frame / shown * frame_count)] += 1
+    return holds
+
+
+def encode_held_frames(frames, holds, output_path, size, fps=24, audio_path=None,
+                       preset=None, crf=None, threads=None, on_progress=None, output_size=None):
+    """Encode a video in which frames[k] is shown for holds[k] frames at `fps`.
+
+    `frames` is any iterable of RGB PIL images (or arrays) yielding exactly
+    len(holds) items; each one is piped to a single ffmpeg process once, no
+    matter how long it is held. The output is variable frame rate: held frames
+    become one long frame instead of many identical ones. Frames are `size`;
+    pass `output_size` to have ffmpeg scale them.
+
+    `on_progress(seconds_encoded, total_seconds)` is called from a helper
+    thread as ffmpeg reports progress.
+    """
+    if not holds:
+        raise ValueError("Nothing to encode")
+
+    preset = preset or VIDEO_PRESET
+    crf = VIDEO_CRF if crf is None else crf
+    threads = VIDEO_THREADS if threads is None else threads
+    width, height = size
+    total_frames = sum(holds)
+    needs_tail = holds[-1] > 1
+
+    # The timeline expression grows with the conversation, so pass it as a
+    # script file rather than on the command line
+    fd, filter_script = tempfile.mkstemp(suffix=".txt")
+    with os.fdopen(fd, "w") as f:
+        f.write(hold_timeline_filter(holds, fps))
+        if output_size and tuple(output_size) != (width, height):
+            f.write(",scale={}:{}".format(*output_size))
+        # 4:2:0 chroma needs even dimensions, and the phone frame is 375x667
+        f.write(",pad=ceil(iw/2)*2:ceil(ih/2)*2")
+
+    cmd = [
+        get_ffmpeg_exe(), "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "pipe:0",
+    ]
+    if audio_path:
+        cmd += ["-i", audio_path]
+    cmd += [
+        "-filter_script:v", filter_script, "-vsync", "vfr",
+        "-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-threads", str(threads),
+        # Left to itself x264 keeps rgb24's full chroma (High 4:4:4), which
+        # Safari's HLS player and most mobile hardware decoders can't play
+        "-pix_fmt", "yuv420p",
+        # B-frames reorder timestamps and make the muxer miscount the duration
+        # of a variable frame rate stream
+        "-bf", "0",
+    ]
+    if audio_path:
+        cmd += ["-c:a", "aac"]
+    cmd += ["-t", f"{total_frames / fps:.6f}", "-progress", "pipe:1", "-nostats", output_path]
+
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    reader = threading.Thread(target=_read_progress, args=(proc.stdout, total_frames / fps, on_progress), daemon=True)
+    reader.start()
+    try:
+        last = None
+        written = 0
+        try:
+            for frame in frames:
+                last = frame.tobytes()
+                proc.stdin.write(last)
+                written += 1
+            if needs_tail and last is not None:
+                proc.stdin.write(last)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        stderr = proc.stderr.read().decode(errors="replace")
+        proc.wait()
+        reader.join()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        os.remove(filter_script)
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed ({proc.returncode}): {stderr.strip()[-2000:]}")
+    if written != len(holds):
+        raise ValueError(f"Expected {len(holds)} frames, got {written}")
+
+    return output_path
+
+
+class SegmentedEncoder:
+    """Encodes a video in independent segments while it is still being produced.
+
+    Frames and their holds are handed over with add() as soon as they are
+    known. Every `segment_seconds` of video is encoded to its own file on a
+    background thread, so encoding overlaps with whatever produces the next
+    frames; a hold that straddles a boundary is split across two segments.
+    finish() encodes the remainder, then joins the segments, adding the
+    soundtrack, without re-encoding the video.
+
+    If `on_segment(path, seconds)` is given it is called on the encoding
+    thread as each segment is finished.
+
+    `segments` are (path, seconds) segments an earlier run of the same job
+    already encoded: as many held frames as they cover are skipped by add(),
+    so those frames may be None, and finish() joins them first.
+    """
+
+    def __init__(self, directory, size, fps=24, segment_seconds=None, on_progress=None, on_segment=None,
+                 output_size=None, preset=None, segments=None):
+        self.directory = directory
+        self.size = size
+        self.output_size = output_size
+        self.preset = preset
+        self.fps = fps
+        self.segment_frames = max(1, round((VIDEO_SEGMENT_SECONDS if segment_seconds is None else segment_seconds) * fps))
+        self.on_progress = on_progress
+        self.on_segment = on_segment
+        self._done = [tuple(segment) for segment in segments or ()]
+        self.encoded_seconds = sum(seconds for _, seconds in self._done)
+        self._skip = round(self.encoded_seconds * fps)
+        self._frames = []
+        self._holds = []
+        self._futures = []
+        self._lock = threading.Lock()
+        # One segment at a time keeps them in order and leaves the other
+        # cores to rendering
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def segment_seconds(self):
+        return self.segment_frames / self.fps
+
+    def add(self, frames, holds):
+        for frame, hold in zip(frames, holds):
+            skipped = min(hold, self._skip)
+            self._skip -= skipped
+            hold -= skipped
+            while hold > 0:
+                take = min(hold, self.segment_frames - sum(self._holds))
+                self._frames.append(frame)
+                self._holds.append(take)
+                hold -= take
+                if sum(self._holds) >= self.segment_frames:
+                    self.flush()
+
+    def flush(self):
+        if not self._holds:
+            return
+        # Surface a failed segment now rather than after rendering the rest
+        for future in self._futures:
+            if future.done():
+                future.result()
+        path = os.path.join(self.directory, f"segment_{len(self._done) + len(self._futures):04}.mp4")
+        frames, holds = self._frames, self._holds
+        self._frames, self._holds = [], []
+        self._futures.append(self._pool.submit(self._encode, frames, holds, path))
+
+    def finish(self, output_path, audio_path=None, audio_codec="aac"):
+        """Encode what is left, join the segments into `output_path` and return it."""
+        try:
+            self.flush()
+            segments = self._done + [future.result() for future in self._futures]
+        finally:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+        if not segments:
+            raise ValueError("Nothing to encode")
+        with metrics.span("mux"):
+            return concat_segments(segments, output_path, audio_path, audio_codec)
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def _encode(self, frames, holds, path):
+        with metrics.span("encode_segment"):
+            encode_held_frames(frames, holds, path, self.size, fps=self.fps, preset=self.preset, output_size=self.output_size)
+        seconds = sum(holds) / self.fps
+        if self.on_segment:
+            self.on_segment(path, seconds)
+        with self._lock:
+            self.encoded_seconds += seconds
+            encoded = self.encoded_seconds
+        if self.on_progress:
+            self.on_progress(encoded)
+        return path, seconds
+
+
+def concat_segments(segments, output_path, audio_path=None, audio_codec="aac"):
+    """Join (path, seconds) video segments into one MP4, muxing in `audio_path`.
+
+    The video is copied, not re-encoded; pass audio_codec="copy" for audio
+    that is already AAC. Durations are written into the
+    concat list so each segment starts exactly where the previous one ends.
+    """
+    fd, list_path = tempfile.mkstemp(suffix=".txt")
+    with os.fdopen(fd, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        for path, seconds in segments:
+            f.write(f"file '{os.path.abspath(path)}'\nduration {seconds:.6f}\n")
+
+    # Written under a temporary name and renamed into place, so a download
+    # never sees a half-written file and a new render gets a new ETag
+    partial_path = f"{output_path}.part.mp4"
+    total_seconds = sum(seconds for _, seconds in segments)
+    cmd = [get_ffmpeg_exe(), "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path]
+    if audio_path:
+        cmd += ["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0", "-c:a", audio_codec]
+    cmd += ["-c:v", "copy", "-t", f"{total_seconds:.6f}", partial_path]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    finally:
+        os.remove(list_path)
+    if result.returncode != 0:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise RuntimeError(f"ffmpeg failed ({result.returncode}): {result.stderr.decode(errors='replace').strip()[-2000:]}")
+    os.replace(partial_path, output_path)
+    return output_path
+
+
+def _read_progress(stream, total_seconds, on_progress):
+    # ffmpeg writes key=value blocks; out_time_ms is in microseconds despite the name
+    for line in stream:
+        key, _, value = line.decode(errors="replace").strip().partition("=")
+        if on_progress is None:
+            continue
+        if key == "out_time_ms" and value.lstrip("-").isdigit():
+            on_progress(min(int(value) / 1_000_000, total_seconds), total_seconds)
+        elif key == "progress" and value == "end":
+            on_progress(total_seconds, total_seconds)
@@ -1,23 +1,70 @@
-import openai
 from datetime import datetime, timedelta
 import os
-from dotenv import load_dotenv
 import json
+from openai_scheduler import openai_requests
 
-load_dotenv(dotenv_path=".env.local")
+def generate_fake_convo(names=("Alice", "You"), n_messages=20, style="light and funny", prompt=None):
+    check_api_key()
+    current_time = datetime.now()
+
+    system_prompt = build_system_prompt(names, n_messages, style, prompt)
+
+    response = openai_requests.call("chat", lambda client: client.chat.completions.with_raw_response.create(
+        model="gpt-3.5-turbo",
+        messages=[{"role": "system", "content": system_prompt}],
+        temperature=0.9,
+        # Writing a long conversation can take minutes
+        timeout=600,
+    )).parse()
+
+    try:
+        convo_data = json.loads(response.choices[0].message.content)
+    except json.JSONDecodeError:
+        raise ValueError("OpenAI did not return valid JSON.")
 
+    # Add timestamps
+    convo = []
+    for msg in convo_data:
+        current_time += timedelta(minutes=1)
+        convo.append(timestamped(msg, current_time))
 
-dotenv_path = os.path.join(os.path.dirname(__file__), ".env.local")
-load_dotenv(dotenv_path=dotenv_path)
+    return convo
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-print("[DEBUG] Loaded OPENAI_API_KEY:", OPENAI_API_KEY[:10] if OPENAI_API_KEY else "NOT FOUND")
+def stream_fake_convo(names=("Alice", "You"), n_messages=20, style="light and funny", prompt=None):
+    """Like generate_fake_convo, but yield each message as soon as the model has written it.
 
-if not OPENAI_API_KEY:
-    raise ValueError("OpenAI API key not found!")
+    The completion is streamed and its JSON array parsed as it arrives, so
+    the first message is ready after a fraction of the time the whole
+    conversation takes. Raises ValueError at the end if the reply wasn't a
+    complete JSON array.
+    """
+    check_api_key()
+    current_time = datetime.now()
 
-def generate_fake_convo(names=("Alice", "You"), n_messages=20, style="light and funny", prompt=None):
-    # Check for API key
+    system_prompt = build_system_prompt(names, n_messages, style, prompt)
+
+    # Request metrics cover the wait for the first byte; the reply streams
+    # in below
+    response = openai_requests.call("chat", lambda client: client.chat.completions.with_raw_response.create(
+        model="gpt-3.5-turbo",
+        messages=[{"role": "system", "content": system_prompt}],
+        temperature=0.9,
+        timeout=600,
+        stream=True,
+    )).parse()
+
+    parser = JSONArrayParser()
+    try:
+        for chunk in response:
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            for msg in parser.feed(text or ""):
+                current_time += timedelta(minutes=1)
+                yield timestamped(msg, current_time)
+    finally:
+        response.close()
+    parser.close()
+
+def check_api_key():
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise ValueError(
@@ -25,13 +72,11 @@ def generate_fake_convo(names=("Alice", "You"), n_messages=20, style="light and
             "1. Set the OPENAI_API_KEY environment variable:\n"
             "   Windows: set OPENAI_API_KEY=your-api-key-here\n"
             "   Linux/Mac: export OPENAI_API_KEY=your-api-key-here\n"
-            "2. Or modify this code to directly set the API key:\n"
-            "   openai.api_key = 'your-api-key-here'"
+            "2. Or add it to .env.local:\n"
+            "   OPENAI_API_KEY=your-api-key-here"
         )
 
-    openai.api_key = api_key
-    current_time = datetime.now()
-
+def build_system_prompt(names, n_messages, style, prompt=None):
     # Create system prompt with optional user prompt
     system_prompt = f"""
     You are simulating a text message conversation between two people named {names[0]} and {names[1]}.
@@ -47,26 +92,77 @@ def generate_fake_convo(names=("Alice", "You"), n_messages=20, style="light and
     [{"sender": "Alice", "text": "Hey!"}, ...]
     Only return the JSON. Do not include explanations or markdown.
     """
+    return system_prompt
 
-    response = openai.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "system", "content": system_prompt}],
-        temperature=0.9
-    )
+def timestamped(msg, time):
+    return {
+        "sender": msg["sender"],
+        "text": msg["text"],
+        "time": time.strftime("%I:%M %p")
+    }
 
-    try:
-        convo_data = json.loads(response.choices[0].message.content)
-    except json.JSONDecodeError:
-        raise ValueError("OpenAI did not return valid JSON.")
 
-    # Add timestamps
-    convo = []
-    for msg in convo_data:
-        current_time += timedelta(minutes=1)
-        convo.append({
-            "sender": msg["sender"],
-            "text": msg["text"],
-            "time": current_time.strftime("%I:%M %p")
-        })
+class JSONArrayParser:
+    """Pull the objects out of a JSON array whose text arrives in pieces.
 
-    return convo
+    feed() returns every element completed by the new text. Only the text of
+    the element in progress is kept, and each character is scanned once.
+    Anything before the opening bracket, such as a markdown fence, is
+    skipped. Elements are expected to be objects or arrays; anything else
+    at the top level of the array is ignored.
+    """
+
+    def __init__(self):
+        self._pending = ""  # text of the element in progress
+        self._opened = False
+        self._closed = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        items = []
+        start = 0 if self._depth else None
+        for i, char in enumerate(text):
+            if self._closed:
+                break
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif not self._opened:
+                self._opened = char == "["
+            elif char in "{[":
+                if self._depth == 0:
+                    start = i
+                self._depth += 1
+            elif char in "}]":
+                if self._depth == 0:
+                    # The array's own closing bracket
+                    self._closed = char == "]"
+                    continue
+                self._depth -= 1
+                if self._depth == 0:
+                    items.append(self._parse(self._pending + text[start:i + 1]))
+                    self._pending = ""
+                    start = None
+            elif char == '"' and self._depth:
+                self._in_string = True
+        if start is not None:
+            self._pending += text[start:]
+        return items
+
+    def close(self):
+        """Raise ValueError unless the whole array has been seen."""
+        if not self._closed:
+            raise ValueError("OpenAI did not return valid JSON.")
+
+    @staticmethod
+    def _parse(text):
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            raise ValueError("OpenAI did not return valid JSON.")
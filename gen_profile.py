@@ -1,33 +1,44 @@
 from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache
+import numpy as np
 import os
 import platform
 
-def generate_contact_image(name, size=256, font_size=100, font_path=None):
-    # Extract initials
-    initials = "".join([part[0] for part in name.split()[:2]]).upper()
+# Handle deprecation of ANTIALIAS
+try:
+    RESAMPLING = Image.Resampling.LANCZOS
+except AttributeError:
+    RESAMPLING = Image.LANCZOS
 
-    # Create square image
-    img = Image.new("RGB", (size, size))
-    draw = ImageDraw.Draw(img)
+# Header-sized avatars kept in memory, one per (initials, size)
+AVATAR_CACHE_SIZE = int(os.getenv("AVATAR_CACHE_SIZE", 256))
 
-    # Draw gradient background (darker)
-    for y in range(size):
-        gradient = int(50 + 55 * (y / size))  # dark gray to slightly lighter gray
-        draw.line([(0, y), (size, y)], fill=(gradient, gradient, gradient))
 
-    # Load font
-    if not font_path:
-        if platform.system() == "Darwin":
-            font_path = "/System/Library/Fonts/SFNSDisplay.ttf"
-        elif platform.system() == "Windows":
-            font_path = "C:\\Windows\\Fonts\\arial.ttf"
-        else:
-            font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+def get_initials(name):
+    return "".join([part[0] for part in name.split()[:2]]).upper()
 
-    if not os.path.exists(font_path):
-        raise FileNotFoundError("Font not found at: " + font_path)
+def generate_contact_image(name, size=256, font_size=100, font_path=None):
+    return render_initials(get_initials(name), size, font_size, font_path).copy()
+
+@lru_cache(maxsize=AVATAR_CACHE_SIZE)
+def contact_avatar(initials, size):
+    """The initials avatar as an RGB image `size` pixels square, ready for the header.
+
+    Drawn at full size and scaled down like a saved avatar used to be, so
+    videos look the same. Cached and shared; don't modify the result.
+    """
+    return render_initials(initials).convert("RGB").resize((size, size), RESAMPLING)
 
-    font = ImageFont.truetype(font_path, font_size)
+@lru_cache(maxsize=32)
+def render_initials(initials, size=256, font_size=100, font_path=None):
+    # Create square image with a gradient background (darker): dark gray to
+    # slightly lighter gray, top to bottom
+    gradient = (50 + 55 * (np.arange(size) / size)).astype(np.uint8)
+    pixels = np.repeat(gradient[:, None], size * 3, axis=1).reshape(size, size, 3)
+    img = Image.fromarray(pixels, "RGB")
+    draw = ImageDraw.Draw(img)
+
+    font = load_font(font_path, font_size)
 
     # Calculate text position to center it
     bbox = font.getbbox(initials)
@@ -46,3 +57,19 @@ def generate_contact_image(name, size=256, font_size=100, font_path=None):
     img.putalpha(mask)
 
     return img
+
+@lru_cache(maxsize=None)
+def load_font(font_path=None, font_size=100):
+    """Load the initials font once per path and size."""
+    if not font_path:
+        if platform.system() == "Darwin":
+            font_path = "/System/Library/Fonts/SFNSDisplay.ttf"
+        elif platform.system() == "Windows":
+            font_path = "C:\\Windows\\Fonts\\arial.ttf"
+        else:
+            font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+    if not os.path.exists(font_path):
+        raise FileNotFoundError("Font not found at: " + font_path)
+
+    return ImageFont.truetype(font_path, font_size)
@@ -0,0 +1,263 @@
+import math
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from audio_mix import SAMPLE_RATE
+from encoder import get_ffmpeg_exe
+from metrics import metrics
+from workspace import stream_dir
+
+# Jobs that ask for it with "stream": true are also published as a growing
+# HLS playlist while they render; set to 0 to never publish streams
+HLS_OUTPUT = os.getenv("HLS_OUTPUT", "1") != "0"
+
+PLAYLIST_NAME = "playlist.m3u8"
+INIT_NAME = "init.mp4"
+SEGMENT_PATTERN = "segment_{:04}.m4s"
+# Samples per AAC packet
+AAC_FRAME_SAMPLES = 1024
+
+
+class HLSPublisher:
+    """Publishes a video as fragmented-MP4 HLS, one segment at a time.
+
+    Each encoded video segment is muxed with the AAC packets of the
+    soundtrack that play over it into a fragment and written to `directory`
+    next to a playlist that lists every fragment so far, so a player can
+    start while the rest of the video is still being made. Muxing happens
+    on a helper thread, in order, so it
+    doesn't hold up whoever hands segments over. finish() waits for it and
+    marks the playlist complete.
+
+    Segments are encoded independently with identical settings, so they
+    share one init section (ftyp + moov); only the fragments (moof + mdat)
+    of each are published after the first. Publishing is best effort: a
+    failure is logged, stops the stream and leaves the job itself alone.
+
+    The soundtrack is read from `audio_path`, an ADTS file that may still be
+    growing; call audio_finished() once nothing more will be written to it.
+    It is encoded once for the whole video and only split at packet
+    boundaries, so there are no gaps or encoder restarts between segments.
+    """
+
+    def __init__(self, directory, target_seconds, audio_path=None, sample_rate=SAMPLE_RATE):
+        self.directory = directory
+        self.target_duration = max(1, math.ceil(target_seconds))
+        self.audio_path = audio_path
+        self.sample_rate = sample_rate
+        self.segments = []
+        self.broken = False
+        self._video_seconds = 0.0
+        self._audio_offset = 0
+        self._audio_packets = 0
+        self._audio_done = threading.Event()
+        self._sequence = 0
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        # A re-run job starts its stream over
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+        self._write_playlist(ended=False)
+
+    def publish(self, video_path, seconds):
+        """Queue the video segment at `video_path`, `seconds` long."""
+        self._pool.submit(self._publish_or_stop, video_path, seconds)
+
+    def audio_finished(self):
+        self._audio_done.set()
+
+    def finish(self):
+        self._pool.shutdown(wait=True)
+        if not self.broken:
+            self._write_playlist(ended=True)
+
+    def abort(self):
+        """Take the stream down, e.g. because the job failed."""
+        self.broken = True
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _publish_or_stop(self, video_path, seconds):
+        if self.broken:
+            return
+        try:
+            with metrics.span("hls_publish"):
+                self._publish(video_path, seconds)
+        except Exception as e:
+            print(f"[WARN] Stopped publishing HLS stream in {self.directory}: {e}")
+            self.broken = True
+
+    def _publish(self, video_path, seconds):
+        audio_start = self._audio_packets * AAC_FRAME_SAMPLES / self.sample_rate
+        packets = self._take_audio(self._video_seconds + seconds) if self.audio_path else []
+
+        cmd = [
+            get_ffmpeg_exe(), "-y", "-loglevel", "error",
+            "-itsoffset", f"{self._video_seconds:.6f}", "-i", video_path,
+        ]
+        if packets:
+            cmd += [
+                "-f", "aac", "-itsoffset", f"{audio_start:.6f}", "-i", "pipe:0",
+                "-map", "0:v", "-map", "1:a", "-c:a", "copy", "-bsf:a", "aac_adtstoasc",
+            ]
+        # Keep the offsets above as real timestamps, so every fragment's
+        # decode time carries on from the one before
+        cmd += [
+            "-c:v", "copy", "-copyts", "-avoid_negative_ts", "disabled", "-use_editlist", "0",
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof+frag_discont",
+            "-f", "mp4", "pipe:1",
+        ]
+        result = subprocess.run(
+            cmd, input=b"".join(packets) if packets else None,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed ({result.returncode}): {result.stderr.decode(errors='replace').strip()[-2000:]}")
+
+        init, fragments = [], []
+        for kind, box in _boxes(result.stdout):
+            if kind in (b"ftyp", b"moov"):
+                init.append(box)
+            elif kind == b"moof":
+                fragments.append(self._renumber(box))
+            elif kind == b"mdat":
+                fragments.append(box)
+
+        if not self.segments:
+            _write_atomic(os.path.join(self.directory, INIT_NAME), b"".join(init))
+        name = SEGMENT_PATTERN.format(len(self.segments))
+        _write_atomic(os.path.join(self.directory, name), b"".join(fragments))
+
+        self.segments.append((name, seconds))
+        self._video_seconds += seconds
+        self._write_playlist(ended=False)
+
+    def _take_audio(self, end_seconds):
+        """The ADTS packets not taken yet that start before `end_seconds`.
+
+        Waits for the soundtrack encoder to catch up if they aren't all
+        written yet; once it has finished, returns whatever is left.
+        """
+        wanted = math.ceil(end_seconds * self.sample_rate / AAC_FRAME_SAMPLES) - self._audio_packets
+        packets = []
+        while len(packets) < wanted:
+            if self.broken:
+                raise RuntimeError("Stream aborted")
+            # Checked before reading, so the last packets aren't missed
+            finished = self._audio_done.is_set()
+            packets += self._read_packets(wanted - len(packets))
+            if len(packets) < wanted:
+                if finished:
+                    break
+                time.sleep(0.05)
+        return packets
+
+    def _read_packets(self, limit):
+        try:
+            with open(self.audio_path, "rb") as f:
+                f.seek(self._audio_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        packets = []
+        for packet in _adts_packets(data):
+            if len(packets) == limit:
+                break
+            packets.append(packet)
+            self._audio_offset += len(packet)
+        self._audio_packets += len(packets)
+        return packets
+
+    def _renumber(self, moof):
+        # Fragment sequence numbers must keep increasing across segments;
+        # each ffmpeg run starts them at 1. mfhd is the first box in moof.
+        self._sequence += 1
+        moof = bytearray(moof)
+        if moof[12:16] == b"mfhd":
+            struct.pack_into(">I", moof, 20, self._sequence)
+        return bytes(moof)
+
+    def _write_playlist(self, ended):
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:7",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:EVENT",
+            "#EXT-X-INDEPENDENT-SEGMENTS",
+        ]
+        if self.segments:
+            lines.append(f'#EXT-X-MAP:URI="{INIT_NAME}"')
+        for name, seconds in self.segments:
+            lines += [f"#EXTINF:{seconds:.3f},", name]
+        if ended:
+            lines.append("#EXT-X-ENDLIST")
+        _write_atomic(os.path.join(self.directory, PLAYLIST_NAME), ("\n".join(lines) + "\n").encode())
+
+
+def is_stream_file(name):
+    """Whether `name` is something a stream directory publishes."""
+    if name in (PLAYLIST_NAME, INIT_NAME):
+        return True
+    stem, ext = os.path.splitext(name)
+    return ext == ".m4s" and stem.startswith("segment_") and stem[len("segment_"):].isdigit()
+
+
+def stream_file(job_id, name):
+    """(path, media type, Cache-Control) for a published stream file, or None.
+
+    The playlist changes while the job runs, so clients must revalidate it;
+    the init section and segments never change once written.
+    """
+    if not is_stream_file(name):
+        return None
+    path = os.path.join(stream_dir(job_id), name)
+    if not os.path.isfile(path):
+        return None
+    if name == PLAYLIST_NAME:
+        return path, "application/vnd.apple.mpegurl", "no-cache"
+    return path, "video/mp4", "public, max-age=86400, immutable"
+
+
+def playlist_url(job_id):
+    """Relative URL of a job's playlist, if it has a stream."""
+    if os.path.isfile(os.path.join(stream_dir(job_id), PLAYLIST_NAME)):
+        return f"/stream/{job_id}/{PLAYLIST_NAME}"
+    return None
+
+
+def _adts_packets(data):
+    # Complete ADTS frames at the start of `data`; a partly written one at
+    # the end is left for the next read
+    offset = 0
+    while offset + 7 <= len(data):
+        header = data[offset:offset + 7]
+        if header[0] != 0xFF or header[1] & 0xF0 != 0xF0:
+            raise ValueError("Lost ADTS sync in soundtrack")
+        length = ((header[3] & 0x03) << 11) | (header[4] << 3) | (header[5] >> 5)
+        if length < 7 or offset + length > len(data):
+            break
+        yield data[offset:offset + length]
+        offset += length
+
+
+def _boxes(data):
+    offset = 0
+    while offset + 8 <= len(data):
+        size, kind = struct.unpack_from(">I4s", data, offset)
+        if size < 8:
+            break
+        yield kind, data[offset:offset + size]
+        offset += size
+
+
+def _write_atomic(path, data):
+    # Readers in other processes only ever see whole files
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,455 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+JOB_STORE = os.getenv("JOB_STORE", "sqlite")
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(os.path.dirname(__file__), "output", "jobs.sqlite3"))
+# A processing job whose owner hasn't checked in for this long is orphaned
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", 120))
+# Orphaned jobs are re-queued this many times before being failed
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 2))
+
+# Fields returned to API clients
+PUBLIC_FIELDS = ("status", "progress", "stage", "stage_done", "stage_total", "video_path", "error")
+
+# Columns added after the first release, created on open if missing
+MIGRATIONS = {
+    "stage": "TEXT",
+    "stage_done": "REAL",
+    "stage_total": "REAL",
+    "started_at": "REAL",
+    "fingerprint": "TEXT",
+    "last_used_at": "REAL",
+}
+
+# Statuses a new identical request can reuse instead of rendering again
+REUSABLE_STATUSES = ("queued", "processing", "completed")
+
+
+class MemoryJobStore:
+    """Job records in a dict; for a single process and for tests.
+
+    Records hold the public fields plus `payload` (the request body),
+    `owner` (the scheduler running it), `attempts` and timestamps.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._counters = {}
+        self._batches = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def create(self, job_id, payload, status="queued", fingerprint=None):
+        with self._lock:
+            self._insert(job_id, payload, status, fingerprint)
+
+    def _insert(self, job_id, payload, status, fingerprint):
+        # Caller holds self._lock
+        now = time.time()
+        self._seq += 1
+        self._jobs[job_id] = {
+            "job_id": job_id, "status": status, "progress": 0, "video_path": None, "error": None,
+            "stage": None, "stage_done": None, "stage_total": None,
+            "payload": payload, "owner": None, "attempts": 0, "seq": self._seq,
+            "created_at": now, "updated_at": now, "started_at": None,
+            "fingerprint": fingerprint, "last_used_at": now,
+        }
+
+    def create_or_attach(self, job_id, payload, fingerprint, reusable=None, allow_create=True):
+        """Reuse an identical job if there is one, otherwise create a new one.
+
+        Returns (job_id, outcome): "hit" for a completed job that `reusable`
+        accepts, "coalesced" for one still queued or running, "created" for a
+        new job, or "rejected" when a new job was needed but not allowed.
+        """
+        with self._lock:
+            matches = [j for j in self._jobs.values() if j["fingerprint"] == fingerprint and j["status"] in REUSABLE_STATUSES]
+            for job in sorted(matches, key=lambda j: j["seq"], reverse=True):
+                if job["status"] != "completed":
+                    return job["job_id"], "coalesced"
+                if reusable is None or reusable(job):
+                    job["last_used_at"] = time.time()
+                    return job["job_id"], "hit"
+                # Its video is gone; stop offering it
+                job["fingerprint"] = None
+            if not allow_create:
+                return None, "rejected"
+            self._insert(job_id, payload, "queued", fingerprint)
+            return job_id, "created"
+
+    def trim_fingerprints(self, max_entries):
+        """Forget all but the `max_entries` most recently used completed results."""
+        with self._lock:
+            cached = [j for j in self._jobs.values() if j["status"] == "completed" and j["fingerprint"]]
+            cached.sort(key=lambda j: j["last_used_at"], reverse=True)
+            for job in cached[max_entries:]:
+                job["fingerprint"] = None
+            return max(0, len(cached) - max_entries)
+
+    def count_cached(self):
+        with self._lock:
+            return sum(1 for j in self._jobs.values() if j["status"] == "completed" and j["fingerprint"])
+
+    def incr(self, name, by=1):
+        self.incr_many({name: by})
+
+    def incr_many(self, values):
+        with self._lock:
+            for name, by in values.items():
+                self._counters[name] = self._counters.get(name, 0) + by
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def get_many(self, job_ids):
+        """{job_id: record} for those of `job_ids` that exist."""
+        with self._lock:
+            return {job_id: dict(self._jobs[job_id]) for job_id in set(job_ids) if job_id in self._jobs}
+
+    def create_batch(self, batch_id, items):
+        """Record a batch: `items` is a list of {"job_id", "cache"}, one per request."""
+        with self._lock:
+            self._batches[batch_id] = {"batch_id": batch_id, "items": list(items), "created_at": time.time()}
+
+    def get_batch(self, batch_id):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            return dict(batch) if batch else None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update({"updated_at": time.time(), **fields})
+
+    def transition(self, job_id, from_status, to_status, **fields):
+        """Move a job between states only if it is still in `from_status`."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or job["status"] != from_status:
+                return False
+            job.update(fields, status=to_status, updated_at=time.time())
+            return True
+
+    def claim_next(self, owner):
+        """Atomically take the oldest queued job and mark it processing."""
+        with self._lock:
+            queued = [job for job in self._jobs.values() if job["status"] == "queued"]
+            if not queued:
+                return None
+            job = min(queued, key=lambda j: j["seq"])
+            now = time.time()
+            job.update(status="processing", owner=owner, attempts=job["attempts"] + 1, updated_at=now, started_at=now)
+            return dict(job)
+
+    def heartbeat(self, owner, job_ids):
+        now = time.time()
+        with self._lock:
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job and job["owner"] == owner and job["status"] == "processing":
+                    job["updated_at"] = now
+
+    def count(self, status):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job["status"] == status)
+
+    def queue_position(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or job["status"] != "queued":
+                return None
+            return sum(1 for j in self._jobs.values() if j["status"] == "queued" and j["seq"] <= job["seq"])
+
+    def recover(self, stale_seconds=JOB_STALE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        """Re-queue or fail processing jobs whose owner stopped checking in."""
+        cutoff = time.time() - stale_seconds
+        requeued = failed = 0
+        with self._lock:
+            for job in self._jobs.values():
+                if job["status"] != "processing" or job["updated_at"] > cutoff:
+                    continue
+                if job["attempts"] < max_attempts:
+                    job.update(status="queued", owner=None, updated_at=time.time())
+                    requeued += 1
+                else:
+                    job.update(status="error", error="Worker lost while processing", updated_at=time.time())
+                    failed += 1
+        return requeued, failed
+
+
+class SQLiteJobStore:
+    """Job records in a SQLite database shared by every process on the host.
+
+    The database runs in WAL mode so status polls never block writers.
+    State changes are conditional updates, and claiming the next job happens
+    inside an immediate transaction, so several server workers can share one
+    queue without running a job twice.
+    """
+
+    def __init__(self, path=JOB_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL UNIQUE,
+                    status TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    video_path TEXT,
+                    error TEXT,
+                    payload TEXT,
+                    owner TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq)")
+            existing = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in MIGRATIONS.items():
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_fingerprint ON jobs (fingerprint, seq)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS batches (batch_id TEXT PRIMARY KEY, items TEXT NOT NULL, created_at REAL NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    def create(self, job_id, payload, status="queued", fingerprint=None):
+        with self._connect() as conn:
+            self._insert(conn, job_id, payload, status, fingerprint)
+
+    def _insert(self, conn, job_id, payload, status, fingerprint):
+        now = time.time()
+        conn.execute(
+            """INSERT INTO jobs (job_id, status, payload, fingerprint, created_at, updated_at, last_used_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (job_id, status, json.dumps(payload), fingerprint, now, now, now),
+        )
+
+    def create_or_attach(self, job_id, payload, fingerprint, reusable=None, allow_create=True):
+        """Reuse an identical job if there is one, otherwise create a new one.
+
+        The lookup and the insert share one immediate transaction, so
+        identical requests racing through different server processes still
+        end up on a single job. Returns (job_id, outcome) as for
+        MemoryJobStore.create_or_attach.
+        """
+        placeholders = ", ".join("?" for _ in REUSABLE_STATUSES)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                f"SELECT * FROM jobs WHERE fingerprint = ? AND status IN ({placeholders}) ORDER BY seq DESC",
+                (fingerprint, *REUSABLE_STATUSES),
+            ).fetchall()
+            for row in rows:
+                if row["status"] != "completed":
+                    return row["job_id"], "coalesced"
+                if reusable is None or reusable(_row_to_job(row)):
+                    conn.execute("UPDATE jobs SET last_used_at = ? WHERE seq = ?", (time.time(), row["seq"]))
+                    return row["job_id"], "hit"
+                conn.execute("UPDATE jobs SET fingerprint = NULL WHERE seq = ?", (row["seq"],))
+            if not allow_create:
+                return None, "rejected"
+            self._insert(conn, job_id, payload, "queued", fingerprint)
+            return job_id, "created"
+
+    def trim_fingerprints(self, max_entries):
+        """Forget all but the `max_entries` most recently used completed results."""
+        with self._connect() as conn:
+            return conn.execute(
+                """UPDATE jobs SET fingerprint = NULL
+                   WHERE status = 'completed' AND fingerprint IS NOT NULL AND seq NOT IN (
+                       SELECT seq FROM jobs WHERE status = 'completed' AND fingerprint IS NOT NULL
+                       ORDER BY last_used_at DESC LIMIT ?)""",
+                (max_entries,),
+            ).rowcount
+
+    def count_cached(self):
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'completed' AND fingerprint IS NOT NULL"
+            ).fetchone()[0]
+
+    def incr(self, name, by=1):
+        self.incr_many({name: by})
+
+    def incr_many(self, values):
+        """Add to several counters in one transaction."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+                [(name, by, by) for name, by in values.items()],
+            )
+
+    def counters(self):
+        with self._connect() as conn:
+            return {row["name"]: row["value"] for row in conn.execute("SELECT name, value FROM counters")}
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return _row_to_job(row)
+
+    def get_many(self, job_ids):
+        """{job_id: record} for those of `job_ids` that exist."""
+        job_ids = list(set(job_ids))
+        jobs = {}
+        with self._connect() as conn:
+            # Stay well under SQLite's limit on bound parameters
+            for start in range(0, len(job_ids), 500):
+                chunk = job_ids[start:start + 500]
+                placeholders = ", ".join("?" for _ in chunk)
+                for row in conn.execute(f"SELECT * FROM jobs WHERE job_id IN ({placeholders})", chunk):
+                    jobs[row["job_id"]] = _row_to_job(row)
+        return jobs
+
+    def create_batch(self, batch_id, items):
+        """Record a batch: `items` is a list of {"job_id", "cache"}, one per request."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO batches (batch_id, items, created_at) VALUES (?, ?, ?)",
+                (batch_id, json.dumps(items), time.time()),
+            )
+
+    def get_batch(self, batch_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+        if row is None:
+            return None
+        return {"batch_id": row["batch_id"], "items": json.loads(row["items"]), "created_at": row["created_at"]}
+
+    def update(self, job_id, **fields):
+        fields.setdefault("updated_at", time.time())
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def transition(self, job_id, from_status, to_status, **fields):
+        """Move a job between states only if it is still in `from_status`."""
+        fields.update(status=to_status, updated_at=time.time())
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE job_id = ? AND status = ?",
+                (*fields.values(), job_id, from_status),
+            )
+            return cursor.rowcount == 1
+
+    def claim_next(self, owner):
+        """Atomically take the oldest queued job and mark it processing."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY seq LIMIT 1").fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'processing', owner = ?, attempts = attempts + 1, updated_at = ?, started_at = ? WHERE seq = ?",
+                (owner, now, now, row["seq"]),
+            )
+        job = _row_to_job(row)
+        job.update(status="processing", owner=owner, attempts=job["attempts"] + 1, started_at=now)
+        return job
+
+    def heartbeat(self, owner, job_ids):
+        if not job_ids:
+            return
+        placeholders = ", ".join("?" for _ in job_ids)
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE jobs SET updated_at = ? WHERE owner = ? AND status = 'processing' AND job_id IN ({placeholders})",
+                (time.time(), owner, *job_ids),
+            )
+
+    def count(self, status):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def queue_position(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                """SELECT COUNT(*) FROM jobs AS ahead, jobs AS job
+                   WHERE job.job_id = ? AND job.status = 'queued'
+                     AND ahead.status = 'queued' AND ahead.seq <= job.seq""",
+                (job_id,),
+            ).fetchone()
+        return row[0] or None
+
+    def recover(self, stale_seconds=JOB_STALE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        """Re-queue or fail processing jobs whose owner stopped checking in."""
+        now = time.time()
+        cutoff = now - stale_seconds
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            requeued = conn.execute(
+                """UPDATE jobs SET status = 'queued', owner = NULL, updated_at = ?
+                   WHERE status = 'processing' AND updated_at < ? AND attempts < ?""",
+                (now, cutoff, max_attempts),
+            ).rowcount
+            failed = conn.execute(
+                """UPDATE jobs SET status = 'error', error = 'Worker lost while processing', updated_at = ?
+                   WHERE status = 'processing' AND updated_at < ?""",
+                (now, cutoff),
+            ).rowcount
+        return requeued, failed
+
+
+class _Transaction:
+    """Commit on success, roll back on error, for an autocommit connection."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def _row_to_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job["payload"] = json.loads(job["payload"]) if job["payload"] else None
+    return job
+
+
+def public_job(job):
+    """The part of a job record that is safe to hand to API clients.
+
+    Adds `eta_seconds`, extrapolated from progress so far, while the job runs.
+    """
+    public = {field: job[field] for field in PUBLIC_FIELDS}
+    public["eta_seconds"] = None
+    if job["status"] == "processing" and job["started_at"] and job["progress"]:
+        elapsed = time.time() - job["started_at"]
+        public["eta_seconds"] = round(elapsed * (1 - job["progress"]) / job["progress"], 1)
+    return public
+
+
+def get_job_store():
+    if JOB_STORE == "memory":
+        return MemoryJobStore()
+    return SQLiteJobStore()
@@ -1,198 +1,387 @@
-from gen_messages import generate_fake_convo
-from draw_image import draw_convo_scroll_frames
-from moviepy.editor import ImageSequenceClip, AudioFileClip, CompositeAudioClip
-from audio import generate_voice_clips
-from gen_profile import generate_contact_image
+from draw_image import iter_convo_scroll_frames, WIDTH, FRAME_HEIGHT, PROFILE_IMG_SIZE, SCROLL_MODE
+from encoder import get_ffmpeg_exe, PREVIEW_FPS, PREVIEW_PRESET, PREVIEW_SEGMENT_SECONDS, VIDEO_CRF, VIDEO_PRESET, VIDEO_SEGMENT_SECONDS, SegmentedEncoder, preview_size, spread_holds
+from hls import HLS_OUTPUT, HLSPublisher
+from workspace import JobWorkspace, stream_dir, video_path, sweep_outputs
+from checkpoint import CHECKPOINT_NAME, Checkpoint, checkpoint_key, write_json
+from result_cache import RENDER_VERSION
+from progress import ProgressReporter
+from audio_mix import AudioEncoder, AudioTimeline, decode_audio, duration_of, load_sound_effect
+from audio import iter_voice_clips, estimate_speech_duration, warm_voice_clips
+from pipeline import SharedStream, batched, prefetch
+from metrics import log_timings, metrics
+from gen_messages import generate_fake_convo, stream_fake_convo
+from gen_profile import contact_avatar, get_initials
+from openai_client import get_client
 from PIL import Image
-from io import BytesIO
-import base64
+import json
 import os
-from PIL import Image
+import subprocess
+import time
 
 
-def generate_video(prompt, style, n_messages, job_id=None):
-    convo = generate_fake_convo(n_messages=n_messages, style=style, prompt=prompt)
+VOICES = {
+    "male": "ash",
+    "female": "sage"
+}
 
-    base_dir = os.path.dirname(__file__)
-    output_dir = os.path.join(base_dir, "output")
-    frame_dir = os.path.join(output_dir, "frames")
-    os.makedirs(frame_dir, exist_ok=True)
 
-    transition_frames = draw_convo_scroll_frames(
-        convo,
-        contact_name="Alice",
-        profile_image_path="Profile.jpg",
-        output_dir=frame_dir,
-        num_transition_frames=5
-    )
+def generate_video(prompt, style, n_messages, job_id=None, progress_callback=None, stream=True, hls=False):
+    """Have the chat model write a conversation about `prompt` and render it.
 
-    # Generate frames with reveal animation
-    base_frames, transition_frames, message_bottom_positions, base_frames_dir, transitions_dir = draw_convo_scroll_frames(
-        convo,
-        contact_name="Alice",
-        profile_image_path="Profile.jpg"
-    )
+    With `stream` the reply is parsed as it arrives and each message moves
+    on to TTS and frame rendering as soon as it is complete, so writing the
+    conversation overlaps with everything else instead of coming first.
+    With `hls` the video is also published as an HLS stream while it renders.
+    """
+    contact_name = "Alice"
+    names = (contact_name, "You")
 
-    voice_audio_paths = generate_voice_clips(convo, user_voice="nova", other_voice="fable")
-    text_audio_path = os.path.join(base_dir, "text_audio.mp4")
-    text_sound_clip = None
-    text_sound_duration = 0.5  # Default duration for text sound effect
-    pause_duration = 0.5  # Add pause between messages
+    def write_convo():
+        if stream:
+            return stream_fake_convo(names=names, n_messages=n_messages, style=style, prompt=prompt)
+        return generate_fake_convo(names=names, n_messages=n_messages, style=style, prompt=prompt)
 
-    if os.path.exists(text_audio_path):
-        text_sound_clip = AudioFileClip(text_audio_path)
-        text_sound_duration = text_sound_clip.duration
+    request = {"prompt": prompt, "style": style, "n_messages": n_messages}
+    return produce_video(request, write_convo, contact_name, pick_voices(), job_id, progress_callback, n_messages=n_messages, hls=hls)
 
-    final_frames = []
-    frame_durations = []
-    audio_clips = []
-    current_time = 0
 
-    # Calculate total frames needed for each message
-    frames_per_message = len(transition_frames) // len(convo)
-    
-    for i, (voice_path, msg) in enumerate(zip(voice_audio_paths, convo)):
-        # Add voice clip
-        voice_clip = AudioFileClip(voice_path)
-        voice_duration = voice_clip.duration
-        voice_clip = voice_clip.set_start(current_time)
-        audio_clips.append(voice_clip)
-
-        # Add text sound if available
-        if text_sound_clip is not None:
-            text_sound = text_sound_clip.set_start(current_time)
-            text_sound = text_sound.set_duration(min(text_sound_duration, voice_duration))
-            text_sound = text_sound.volumex(0.5)
-            audio_clips.append(text_sound)
-
-        # Calculate frames needed for this message
-        message_frames = int((voice_duration + pause_duration) * 24)  # 24 fps
-        start_frame = i * frames_per_message
-        
-        # Add frames for the message duration
-        for frame in range(message_frames):
-            progress = min(1.0, frame / message_frames)
-            frame_index = start_frame + int(progress * frames_per_message)
-            frame_index = min(frame_index, len(transition_frames) - 1)
-            
-            final_frames.append(transition_frames[frame_index])
-            frame_durations.append(1/24)
-        
-        current_time += voice_duration + pause_duration
-
-    # Create the final video clip
-    video_clip = ImageSequenceClip(final_frames, durations=frame_durations)
-    video_clip = video_clip.set_audio(CompositeAudioClip(audio_clips))
-
-    output_filename = f"chat_video_{job_id}.mp4" if job_id else "chat_video_scroll.mp4"
-    output_path = os.path.join(output_dir, output_filename)
-    video_clip.write_videofile(output_path, fps=24, audio_codec="aac")
+def generate_video_from_json(data, job_id=None, progress_callback=None):
+    """Render the conversation in `data` to an MP4 and return its path.
 
-    return output_path
+    `progress_callback(stage, done, total, overall)` receives throttled
+    stage-level progress: TTS lines done, frames rendered and seconds
+    encoded, plus an overall 0-1 estimate.
 
-    try:
-        # Write video file
-        final_clip.write_videofile(output_path, fps=24, audio_codec="aac")
-        print(f"Video generated successfully: {output_path}")
-        return output_path
-    except Exception as e:
-        print(f"Error generating video: {e}")
-        return None
+    With a true `stream` in `data` the video is also published as an HLS
+    stream while it renders, so playback can start before the MP4 exists.
+
+    With a true `preview` in `data` a quick draft is made instead: silent,
+    lines timed from their text, no HLS stream, and a smaller, lower frame rate,
+    faster encode (PREVIEW_SCALE, PREVIEW_FPS, PREVIEW_PRESET). Its lines
+    are synthesized into the TTS cache in the background, so the full render
+    that follows finds them ready.
+    """
+    voices = pick_voices(data["your_gender"].lower(), data["contact_gender"].lower())
+    return produce_video(
+        data, lambda: data["convo"], data["contact_name"], voices, job_id, progress_callback,
+        scroll_mode=data.get("scroll_mode") or SCROLL_MODE, preview=bool(data.get("preview")),
+        hls=bool(data.get("stream")),
+    )
 
 
-def generate_video_from_json(data, job_id=None):
-    contact_name = data["contact_name"]
-    contact_gender = data["contact_gender"].lower()
-    your_gender = data["your_gender"].lower()
-    convo = data["convo"]
+def pick_voices(your_gender=None, contact_gender=None):
+    """(user_voice, other_voice) for the two genders; nova and fable when unknown."""
+    return VOICES.get(your_gender, "nova"), VOICES.get(contact_gender, "fable")
 
-    voice_map = {
-        "male": "ash",
-        "female": "sage"
-    }
 
-    user_voice = voice_map.get(your_gender, "nova")
-    other_voice = voice_map.get(contact_gender, "fable")
+def produce_video(request, write_convo, contact_name, voices, job_id=None, progress_callback=None, n_messages=None, scroll_mode=None, preview=False, hls=False):
+    """Render one request in its job's workspace and return the MP4's path.
 
+    `write_convo()` returns the conversation, as a list or as an iterator
+    of messages still being written. It is only called when no earlier run
+    of the job recorded the whole conversation; otherwise that run's
+    checkpoint is picked up by render_job and only the stages it didn't
+    finish are done again.
+    """
     base_dir = os.path.dirname(__file__)
-    output_dir = os.path.join(base_dir, "output")
-    frame_dir = os.path.join(output_dir, "frames")
-    os.makedirs(frame_dir, exist_ok=True)
-
-    # Always generate initials-based profile image
-    print(f"[INFO] Generating initials-based profile image for '{contact_name}'...")
-    profile_picture_path = os.path.join(output_dir, f"profile_{contact_name.replace(' ', '_')}_initials.png")
-    img = generate_contact_image(contact_name)
-    img.save(profile_picture_path)
-
-    # Render message frames
-    transition_frames = draw_convo_scroll_frames(
+    reporter = ProgressReporter(progress_callback)
+    # Start this job's stage timings from zero
+    metrics.take_timings()
+    key = checkpoint_key(RENDER_VERSION, VIDEO_PRESET, VIDEO_CRF, scroll_mode or SCROLL_MODE, preview, request)
+
+    # Intermediates live in a private workspace, so concurrent jobs can't
+    # clobber each other. It is deleted as soon as the video is encoded, and
+    # kept for the next attempt if a job with an id fails.
+    with JobWorkspace(job_id, keep_failed=job_id is not None) as workspace:
+        checkpoint = Checkpoint(workspace.file(CHECKPOINT_NAME), key)
+
+        def save_convo(messages):
+            checkpoint.save(convo=write_json(workspace.file("convo.json"), messages))
+
+        convo_path = checkpoint.get("convo")
+        if convo_path and os.path.exists(convo_path):
+            with open(convo_path, encoding="utf-8") as f:
+                convo = json.load(f)
+        else:
+            # Anything an earlier run made belonged to a conversation that
+            # was never finished, and a new one won't match it
+            checkpoint.reset()
+            convo = write_convo()
+            if isinstance(convo, list):
+                save_convo(convo)
+            else:
+                convo = SharedStream(_recorded(convo, save_convo))
+
+        try:
+            output_path = render_job(
+                workspace, convo, contact_name, *voices, base_dir, job_id, reporter, scroll_mode, preview,
+                n_messages=n_messages, checkpoint=checkpoint, hls=hls,
+            )
+        finally:
+            checkpoint.close()
+
+    log_timings(job_id or workspace.job_id, metrics.take_timings())
+    sweep_outputs()
+    return output_path
+
+
+def _recorded(messages, on_complete):
+    # Pass messages through, then hand over the whole list once there are no more
+    written = []
+    for msg in messages:
+        written.append(msg)
+        yield msg
+    on_complete(written)
+
+
+def render_job(workspace, convo, contact_name, user_voice, other_voice, base_dir, job_id=None, reporter=None, scroll_mode=None, preview=False, n_messages=None, checkpoint=None, hls=False):
+    """Render and encode one conversation with every stage running at once.
+
+    Voice lines are requested up front and frames are rendered on a helper
+    thread while they download. Message k is timed and queued for encoding
+    as soon as its own line is in, so by the time the last line arrives most
+    of the video and soundtrack are already encoded; only a copy-only join of
+    the segments is left.
+
+    `convo` is a list of messages, or a SharedStream of messages still
+    being written, with `n_messages` the number expected; each stage then
+    starts on a message as soon as it arrives.
+
+    With `hls`, finished segments are also published as an HLS stream
+    (unless HLS_OUTPUT turns streams off). It costs an extra ffmpeg run per
+    segment, so only jobs someone will watch live ask for it.
+
+    Every stage records what it finishes in `checkpoint`: the avatar, each
+    voice line, each message's timing together with each encoded segment,
+    and the soundtrack. Given the checkpoint of a run that failed, none of
+    that is made again: recorded lines are reused without a request, frames
+    already encoded aren't drawn, and the soundtrack is remixed from the
+    recorded lines unless it was finished too.
+    """
+    reporter = reporter or ProgressReporter()
+    n_messages = n_messages or len(convo)
+    checkpoint = checkpoint or Checkpoint(workspace.file(CHECKPOINT_NAME), None)
+
+    # Each message's line and on-screen time, and the segments they were
+    # encoded into, as far as an earlier run got
+    timed = list(checkpoint.get("messages", []))
+    segments = [tuple(segment) for segment in checkpoint.get("segments", [])]
+    lines_done = {int(i): path for i, path in checkpoint.get("lines", {}).items() if os.path.exists(path)}
+    lines_done.update((i, msg["audio"]) for i, msg in enumerate(timed))
+    soundtrack_path = checkpoint.get("soundtrack")
+    if soundtrack_path and not os.path.exists(soundtrack_path):
+        soundtrack_path = None
+    if lines_done or segments or soundtrack_path:
+        print(f"[INFO] Resuming job {workspace.job_id}: {len(lines_done)} lines, {len(timed)} messages timed, "
+              f"{len(segments)} segments encoded{', soundtrack mixed' if soundtrack_path else ''}")
+
+    avatar_path = checkpoint.get("avatar")
+    if avatar_path and os.path.exists(avatar_path):
+        avatar = Image.open(avatar_path)
+        avatar.load()
+    else:
+        # Always generate initials-based profile image, straight at header size
+        print(f"[INFO] Generating initials-based profile image for '{contact_name}'...")
+        with metrics.span("avatar"):
+            avatar = contact_avatar(get_initials(contact_name), PROFILE_IMG_SIZE)
+        avatar_path = workspace.file("avatar.png")
+        avatar.save(avatar_path)
+        checkpoint.save(avatar=avatar_path)
+    reporter.update("avatar", 1, 1)
+
+    num_transition_frames = 5
+    fps = PREVIEW_FPS if preview else 24
+
+    if preview:
+        # No speech in a draft; every line is held for its estimated length
+        warm_voice_clips(convo, user_voice=user_voice, other_voice=other_voice)
+        voice_audio_paths = (None for _ in convo)
+        reporter.update("tts", 1, 1)
+    else:
+        # Voice lines arrive in conversation order while later ones are still
+        # being synthesized
+        voice_audio_paths = iter_voice_clips(
+            convo, user_voice=user_voice, other_voice=other_voice, workspace=workspace,
+            progress_callback=lambda done, total: reporter.update("tts", done, total), total=n_messages,
+            finished=lines_done, on_line=lambda i, path: checkpoint.save_item("lines", i, path),
+        )
+
+    # Messages whose frames are all in encoded segments aren't drawn again
+    encoded_frames = round(sum(seconds for _, seconds in segments) * fps)
+    skip = sum(1 for msg in timed if msg["end_frame"] <= encoded_frames)
+
+    # Each message's transition frames, rendered ahead on a helper thread
+    message_frames_iter = prefetch(batched(metrics.timed(iter_convo_scroll_frames(
         convo,
         contact_name=contact_name,
-        profile_image_path=profile_picture_path,
-        output_dir=frame_dir,
-        num_transition_frames=5
-    )
+        num_transition_frames=num_transition_frames,
+        profile_image=avatar,
+        mode=scroll_mode,
+        start=skip,
+    ), "frame"), num_transition_frames), max_ahead=4)
 
-    # Generate voice and timing
-    voice_audio_paths = generate_voice_clips(convo, user_voice=user_voice, other_voice=other_voice)
     text_audio_path = os.path.join(base_dir, "text_audio.mp4")
-    text_sound_clip = None
-    text_sound_duration = 0.5  # Default duration for text sound effect
+    text_sound = None
     pause_duration = 0.5  # Add pause between messages
 
-    if os.path.exists(text_audio_path):
-        text_sound_clip = AudioFileClip(text_audio_path)
-        text_sound_duration = text_sound_clip.duration
+    # The total length isn't known until the last line is in; estimate it
+    # from the text so encode progress has something to measure against.
+    # Messages not written yet count as the shortest lines.
+    estimates = [estimate_speech_duration(msg["text"]) for msg in convo] if isinstance(convo, list) else []
+    shortest = estimate_speech_duration("")
+    expected_seconds = sum(estimates) + (n_messages - len(estimates)) * shortest + n_messages * pause_duration
+
+    # Each message's audio is final once the next one is timed, so the
+    # soundtrack is mixed and compressed message by message too. Drafts are
+    # silent.
+    timeline = AudioTimeline()
+    soundtrack = None
+    if not preview and soundtrack_path is None:
+        # Start over from the lines; a half-written track from an earlier
+        # run mustn't be mistaken for this one
+        if os.path.exists(workspace.file("soundtrack.aac")):
+            os.remove(workspace.file("soundtrack.aac"))
+        soundtrack = AudioEncoder(workspace.file("soundtrack.aac"))
+        if os.path.exists(text_audio_path):
+            text_sound = load_sound_effect(text_audio_path)
+
+    def segment_done(path, seconds):
+        # Every message with frames in the segment has been timed by now
+        segments.append((path, seconds))
+        checkpoint.save(segments=segments, messages=list(timed))
+
+    # Finished segments can also be published as HLS, so a player can start
+    # long before the MP4 exists. Drafts are done too soon to need it, and
+    # are encoded in longer segments to spend less time starting ffmpeg.
+    stream = None
+    if hls and HLS_OUTPUT and job_id and not preview:
+        stream = HLSPublisher(stream_dir(job_id), target_seconds=VIDEO_SEGMENT_SECONDS, audio_path=workspace.file("soundtrack.aac"))
+        for path, seconds in segments:
+            stream.publish(path, seconds)
+        if soundtrack is None:
+            stream.audio_finished()
+
+    def on_segment(path, seconds):
+        segment_done(path, seconds)
+        if stream:
+            stream.publish(path, seconds)
+
+    encoder = SegmentedEncoder(
+        os.path.join(workspace.path, "segments"), size=(WIDTH, FRAME_HEIGHT), fps=fps,
+        segment_seconds=PREVIEW_SEGMENT_SECONDS if preview else None,
+        on_progress=lambda done: reporter.update("encode", done, max(expected_seconds, done)),
+        on_segment=on_segment,
+        output_size=preview_size((WIDTH, FRAME_HEIGHT)) if preview else None,
+        preset=PREVIEW_PRESET if preview else None,
+        segments=segments,
+    )
 
-    final_frames = []
-    frame_durations = []
-    audio_clips = []
     current_time = 0
+    rendered = 0
+    lines = 0
 
-    # Calculate total frames needed for each message
-    frames_per_message = len(transition_frames) // len(convo)
-    
-    for i, (voice_path, msg) in enumerate(zip(voice_audio_paths, convo)):
-        # Add voice clip
-        voice_clip = AudioFileClip(voice_path)
-        voice_duration = voice_clip.duration
-        voice_clip = voice_clip.set_start(current_time)
-        audio_clips.append(voice_clip)
-
-        # Add text sound if available
-        if text_sound_clip is not None:
-            text_sound = text_sound_clip.set_start(current_time)
-            text_sound = text_sound.set_duration(min(text_sound_duration, voice_duration))
-            text_sound = text_sound.volumex(0.5)
-            audio_clips.append(text_sound)
-
-        # Calculate frames needed for this message
-        message_frames = int((voice_duration + pause_duration) * 24)  # 24 fps
-        start_frame = i * frames_per_message
-        
-        # Add frames for the message duration
-        for frame in range(message_frames):
-            progress = min(1.0, frame / message_frames)
-            frame_index = start_frame + int(progress * frames_per_message)
-            frame_index = min(frame_index, len(transition_frames) - 1)
-            
-            final_frames.append(transition_frames[frame_index])
-            frame_durations.append(1/24)
-        
-        current_time += voice_duration + pause_duration
-
-    # Create the final video clip
-    video_clip = ImageSequenceClip(final_frames, durations=frame_durations)
-    video_clip = video_clip.set_audio(CompositeAudioClip(audio_clips))
-
-    output_filename = f"chat_video_{job_id}.mp4" if job_id else "chat_video_scroll.mp4"
-    output_path = os.path.join(output_dir, output_filename)
-    video_clip.write_videofile(output_path, fps=24, audio_codec="aac")
+    try:
+        for i, (audio_path, msg, frames) in enumerate(zip(voice_audio_paths, convo, message_frames_iter)):
+            rendered += len(frames)
+            lines = i + 1
+            reporter.update("frames", rendered, num_transition_frames * max(n_messages, lines))
+
+            samples = None
+            if audio_path is not None and (soundtrack or i >= len(timed)):
+                with metrics.span("audio_decode"):
+                    samples = decode_audio(audio_path)
+            if i < len(timed):
+                # Timed by an earlier run, and maybe already encoded that way
+                voice_duration = timed[i]["duration"]
+            elif audio_path is None:
+                # TTS failed for this line: keep it on screen for about as long as
+                # it would take to read, silently, so later lines stay in sync
+                voice_duration = estimate_speech_duration(msg["text"])
+                if not preview:
+                    print(f"[WARN] No voice for line {i}, holding it for {voice_duration:.1f}s")
+            else:
+                voice_duration = duration_of(samples)
+
+            if samples is not None:
+                # Add voice clip
+                timeline.add(samples, start=current_time)
+
+            # Add text sound if available
+            if text_sound is not None:
+                timeline.add(text_sound, start=current_time, gain=0.5, max_duration=voice_duration)
+
+            # Spread the message's on-screen time over its transition frames
+            start_time = current_time
+            current_time += voice_duration + pause_duration
+            holds = spread_holds(len(frames), start_time, current_time, fps)
+            if i >= len(timed):
+                timed.append({"audio": audio_path, "duration": voice_duration, "end_frame": round(current_time * fps)})
+
+            if soundtrack:
+                with metrics.span("audio_mix"):
+                    track = timeline.drain(current_time)
+                # Blocks while ffmpeg catches up, so it is kept apart from mixing
+                with metrics.span("audio_encode"):
+                    soundtrack.write(track)
+            encoder.add(frames, holds)
+            expected_seconds += voice_duration - (estimates[i] if i < len(estimates) else shortest)
+        reporter.update("tts", lines, lines)
+
+        if soundtrack:
+            soundtrack_path = soundtrack.close()
+            checkpoint.save(messages=list(timed), soundtrack=soundtrack_path)
+        if stream:
+            stream.audio_finished()
+        reporter.update("audio", 1, 1)
+
+        output_path = encoder.finish(video_path(job_id), audio_path=soundtrack_path, audio_codec="copy")
+        if stream:
+            stream.finish()
+        reporter.update("encode", 1, 1)
+    except BaseException:
+        if stream:
+            # Let any segment being published finish before removing them
+            encoder.close()
+            stream.abort()
+        raise
+    finally:
+        if soundtrack:
+            soundtrack.abort()
+        encoder.close()
+        message_frames_iter.close()
+        voice_audio_paths.close()
 
     return output_path
 
 
+def warm_up():
+    """Load what a process's first job would otherwise wait for.
+
+    Renders one throwaway frame (fonts, layout, avatar), decodes the text
+    sound effect, runs ffmpeg once so its binary is paged in, and creates the
+    OpenAI client when a key is set. Meant to run as a worker starts, before
+    it is handed a job.
+    """
+    start = time.perf_counter()
+    base_dir = os.path.dirname(__file__)
+    avatar = contact_avatar(get_initials("Warm Up"), PROFILE_IMG_SIZE)
+    convo = [{"sender": "Warm Up", "text": "Hey!", "time": "12:00 PM"}, {"sender": "You", "text": "Hi", "time": "12:01 PM"}]
+    for _ in iter_convo_scroll_frames(convo, contact_name="Warm Up", profile_image=avatar):
+        pass
+
+    text_audio_path = os.path.join(base_dir, "text_audio.mp4")
+    if os.path.exists(text_audio_path):
+        load_sound_effect(text_audio_path)
+    else:
+        subprocess.run([get_ffmpeg_exe(), "-version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        get_client()
+    except ValueError as e:
+        print(f"[WARN] {e}")
+    print(f"[INFO] Warmed up in {time.perf_counter() - start:.2f}s")
+
+
 if __name__ == "__main__":
     output_path = generate_video("A conversation about coding", "great rizz", 15)
     print(f"Video generated: {output_path}")
@@ -0,0 +1,225 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from workspace import OUTPUT_DIR
+
+# Write a cProfile dump of each job to JOB_PROFILE_DIR; off by default
+JOB_PROFILE = os.getenv("JOB_PROFILE", "0") != "0"
+JOB_PROFILE_DIR = os.getenv("JOB_PROFILE_DIR", os.path.join(OUTPUT_DIR, "profiles"))
+
+# Upper bounds, in seconds, of the histogram buckets
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+# type and help text of every metric family /metrics can show
+FAMILIES = {
+    "gentext_stage_seconds": ("histogram", "Time spent in one unit of a pipeline stage"),
+    "gentext_openai_requests_total": ("counter", "OpenAI API requests by endpoint and result"),
+    "gentext_openai_request_seconds": ("histogram", "OpenAI API request latency"),
+    "gentext_openai_limiter_wait_seconds": ("histogram", "Time OpenAI requests waited for the rate limiter"),
+    "gentext_openai_hedges_total": ("counter", "Duplicate speech requests sent for slow lines, by whether the duplicate answered first"),
+    "gentext_tts_cache_total": ("counter", "Voice line lookups in the TTS cache by result"),
+    "gentext_jobs_finished_total": ("counter", "Jobs finished by final status"),
+    "gentext_job_retries_total": ("counter", "Failed jobs re-queued to resume from their checkpoint"),
+    "gentext_job_duration_seconds": ("histogram", "Time from a worker taking a job to it finishing"),
+    "gentext_job_queue_wait_seconds": ("histogram", "Time jobs spent queued before a worker took them"),
+    "gentext_result_cache_requests_total": ("counter", "Generate requests by result cache outcome"),
+    "gentext_result_cache_entries": ("gauge", "Finished videos available for reuse"),
+    "gentext_jobs": ("gauge", "Jobs in the store by status"),
+    "gentext_workers": ("gauge", "Worker processes in this server process's pool"),
+    "gentext_workers_busy": ("gauge", "Workers in this server process's pool running a job"),
+}
+PREFIX = "gentext_"
+
+
+class Metrics:
+    """Counters and histograms collected by this process until flushed.
+
+    Values are kept as Prometheus series names (`name{label="value"}`) so
+    flushing adds them straight onto the job store's counters, where every
+    server and worker process on the host adds up. Worker processes flush
+    once per job; the server flushes before each scrape.
+
+    span() also keeps a per-stage count and total for take_timings(), which
+    a job uses to log where its own time went.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, by=1, **labels):
+        with self._lock:
+            self._add(_series(name, labels), by)
+
+    def observe(self, name, value, buckets=STAGE_BUCKETS, **labels):
+        with self._lock:
+            for bound in buckets:
+                # Empty buckets are added too, so every series has them all
+                self._add(_series(name + "_bucket", {**labels, "le": _format(bound)}), 1 if value <= bound else 0)
+            self._add(_series(name + "_bucket", {**labels, "le": "+Inf"}), 1)
+            self._add(_series(name + "_sum", labels), value)
+            self._add(_series(name + "_count", labels), 1)
+
+    @contextmanager
+    def span(self, stage):
+        """Time the block as one unit of `stage`, whether or not it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record_span(stage, time.perf_counter() - start)
+
+    def timed(self, iterable, stage):
+        """Yield from `iterable`, timing the production of each item as a span."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                # Finding the end isn't producing an item, so it isn't a span
+                return
+            self._record_span(stage, time.perf_counter() - start)
+            yield item
+
+    def _record_span(self, stage, elapsed):
+        self.observe("gentext_stage_seconds", elapsed, stage=stage)
+        with self._lock:
+            count, total = self._timings.get(stage, (0, 0.0))
+            self._timings[stage] = (count + 1, total + elapsed)
+
+    @contextmanager
+    def openai_request(self, endpoint):
+        """Count and time one OpenAI API call."""
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except Exception as e:
+            status = str(getattr(e, "status_code", None) or "error")
+            raise
+        finally:
+            self.observe("gentext_openai_request_seconds", time.perf_counter() - start, endpoint=endpoint)
+            self.inc("gentext_openai_requests_total", endpoint=endpoint, status=status)
+
+    def take_timings(self):
+        """{stage: {"count", "seconds"}} since the last call, then start over."""
+        with self._lock:
+            timings, self._timings = self._timings, {}
+        return {stage: {"count": count, "seconds": round(total, 3)} for stage, (count, total) in sorted(timings.items())}
+
+    def flush(self, store):
+        """Add everything collected so far to the store's counters."""
+        with self._lock:
+            values, self._values = self._values, {}
+        if values:
+            try:
+                store.incr_many(values)
+            except Exception as e:
+                print(f"[WARN] Could not record metrics: {e}")
+
+    def _add(self, series, value):
+        # Caller holds self._lock
+        self._values[series] = self._values.get(series, 0) + value
+
+
+# Shared by everything in this process
+metrics = Metrics()
+
+
+@contextmanager
+def job_profile(job_id):
+    """cProfile the calling thread for the block when JOB_PROFILE is on.
+
+    Only the thread that runs the job is profiled, not the frame, TTS or
+    encoder helper threads. The dump is written to JOB_PROFILE_DIR as
+    <job_id>.prof, for `python -m pstats` or snakeviz.
+    """
+    if not JOB_PROFILE:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(JOB_PROFILE_DIR, exist_ok=True)
+        path = os.path.join(JOB_PROFILE_DIR, f"{job_id}.prof")
+        profiler.dump_stats(path)
+        print(f"[INFO] Wrote profile for job {job_id} to {path}")
+
+
+def log_timings(job_id, timings):
+    print(f"[INFO] Job {job_id} stage timings: {json.dumps(timings)}")
+
+
+def render_metrics(store, scheduler):
+    """The Prometheus text exposition of everything the store has collected.
+
+    Counters and histograms come from the store, so any server process
+    reports the same totals; queue gauges are read from the store at scrape
+    time, and worker gauges describe this process's own pool.
+    """
+    from result_cache import CACHE_COUNTERS
+
+    metrics.flush(store)
+    counters = store.counters()
+    series = {name: value for name, value in counters.items() if name.startswith(PREFIX)}
+    for outcome in CACHE_COUNTERS:
+        series[_series("gentext_result_cache_requests_total", {"outcome": outcome})] = counters.get(outcome, 0)
+    series["gentext_result_cache_entries"] = store.count_cached()
+    for status in ("queued", "processing"):
+        series[_series("gentext_jobs", {"status": status})] = store.count(status)
+    stats = scheduler.stats()
+    series["gentext_workers"] = stats["workers"]
+    series["gentext_workers_busy"] = stats["running"]
+
+    families = {}
+    for name, value in series.items():
+        families.setdefault(_family(name), []).append((name, value))
+    lines = []
+    for family in sorted(families):
+        kind, help_text = FAMILIES.get(family, ("untyped", family))
+        lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {kind}"]
+        for name, value in sorted(families[family], key=lambda item: _sort_key(item[0])):
+            lines.append(f"{name} {_format(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    pairs = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{pairs}}}"
+
+
+def _family(series):
+    name = series.split("{", 1)[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[:-len(suffix)] in FAMILIES:
+            return name[:-len(suffix)]
+    return name
+
+
+def _sort_key(series):
+    # Keep each histogram's buckets in numeric order, +Inf last
+    name, _, labels = series.partition("{")
+    le = None
+    for pair in labels.rstrip("}").split(","):
+        if pair.startswith('le="'):
+            le = pair[4:-1]
+    others = labels.replace(f'le="{le}"', "") if le is not None else labels
+    bound = float("inf") if le in (None, "+Inf") else float(le)
+    return name, others, bound
+
+
+def _format(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,50 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env.local"))  # Load the OpenAI API key
+
+# Point at a local stand-in server for tests and benchmarks
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+# Concurrent TTS lines share the client's connection pool, so keep enough
+# keep-alive connections for all of them
+MAX_CONNECTIONS = max(int(os.getenv("TTS_CONCURRENCY", 4)), 10)
+
+_client = None
+_lock = threading.Lock()
+
+
+def get_client():
+    """The OpenAI client for this process, created on first use.
+
+    openai and httpx are only imported here, so importing the modules that
+    call the API stays cheap, and a missing key is reported when a request
+    is made rather than when the server or a worker starts.
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = _create_client()
+    return _client
+
+
+def _create_client():
+    import httpx
+    from openai import OpenAI
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OpenAI API key not found! Set OPENAI_API_KEY in the environment or in .env.local")
+
+    # Create a custom HTTP client without proxy settings
+    http_client = httpx.Client(
+        base_url=OPENAI_BASE_URL,
+        headers={"Authorization": f"Bearer {api_key}"},
+        follow_redirects=True,
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+    )
+    # Retries are up to openai_scheduler, which paces every request the
+    # process makes
+    return OpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, http_client=http_client, max_retries=0)
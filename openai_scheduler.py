@@ -0,0 +1,308 @@
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed
+from email.utils import parsedate_to_datetime
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+from metrics import metrics
+from openai_client import get_client
+
+# Requests per minute this process may send to each endpoint. 0 leaves the
+# pace to the rate-limit headers OpenAI sends back with every reply.
+OPENAI_RPM = {
+    "speech": int(os.getenv("OPENAI_SPEECH_RPM", 0)),
+    "chat": int(os.getenv("OPENAI_CHAT_RPM", 0)),
+}
+# Tries per request, counting the first, on 429s, 5xx and connection errors
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", 5))
+# A speech request still unanswered past this percentile of recent
+# latencies is sent again, and whichever copy answers first is used; 0
+# turns hedging off
+OPENAI_HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", 95))
+# Latencies needed before hedging starts, and how many recent ones count
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+# Spread out what is left of the quota once less than this share remains
+LOW_QUOTA = 0.1
+
+RETRY_STATUSES = (408, 409, 429)
+
+
+class EndpointLimiter:
+    """A token bucket for one endpoint, shared fairly between jobs.
+
+    Requests wait in one queue per job and are let through round robin, so
+    a job with hundreds of lines can't hold up one that just started. The
+    bucket refills at the configured rate, or more slowly once the rate-limit
+    headers say the quota is running out, and lets nothing through until
+    the quota resets after a 429 or when none is left.
+    """
+
+    def __init__(self, rpm=0):
+        self.rpm = rpm
+        self._quota_rate = None  # from the headers, when the quota runs low
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queues = OrderedDict()
+        self._changed = threading.Condition()
+
+    def acquire(self, job=None):
+        """Block until a request for `job` may be sent; returns the seconds waited."""
+        start = time.monotonic()
+        ticket = object()
+        with self._changed:
+            self._queues.setdefault(job, deque()).append(ticket)
+            while True:
+                head = next(iter(self._queues))
+                if self._queues[head][0] is ticket:
+                    delay = self._delay()
+                    if delay <= 0:
+                        self._take()
+                        self._queues[head].popleft()
+                        if self._queues[head]:
+                            # Other jobs' requests go before this job's next one
+                            self._queues.move_to_end(head)
+                        else:
+                            del self._queues[head]
+                        self._changed.notify_all()
+                        return time.monotonic() - start
+                    self._changed.wait(delay)
+                else:
+                    self._changed.wait()
+
+    def try_acquire(self):
+        """Take a token if one is free and no request is waiting for it."""
+        with self._changed:
+            if self._queues or self._delay() > 0:
+                return False
+            self._take()
+            return True
+
+    def observe(self, headers, limited=False):
+        """Adjust the pace to the rate-limit headers of a reply; `limited` for a 429.
+
+        OpenAI's quota refills continuously and the reset header says when
+        it will be full again, which gives the refill rate. Once less than
+        LOW_QUOTA of it is left, requests are paced at that rate; with none
+        left, or after a 429, nothing is sent until a request's worth has
+        come back or for as long as the reply asked.
+        """
+        limit = _number(headers.get("x-ratelimit-limit-requests"))
+        remaining = _number(headers.get("x-ratelimit-remaining-requests"))
+        refill = refill_rate(headers)
+        with self._changed:
+            pause = None
+            if limited:
+                pause = retry_after(headers)
+            elif remaining == 0 and refill:
+                pause = 1 / refill
+            if pause:
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            if refill and remaining is not None and remaining < limit * LOW_QUOTA:
+                self._quota_rate = refill
+            else:
+                self._quota_rate = None
+            self._changed.notify_all()
+
+    def _rate(self):
+        rates = [rate for rate in (self.rpm / 60 or None, self._quota_rate) if rate]
+        return min(rates) if rates else None
+
+    def _delay(self):
+        # Caller holds self._changed
+        now = time.monotonic()
+        if self._paused_until > now:
+            return self._paused_until - now
+        rate = self._rate()
+        if rate is None:
+            return 0
+        # Bursts of up to a second's worth of requests
+        self._tokens = min(max(1.0, rate), self._tokens + (now - self._updated) * rate)
+        self._updated = now
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / rate
+
+    def _take(self):
+        if self._rate() is not None:
+            self._tokens -= 1
+
+
+class RequestScheduler:
+    """Every OpenAI request made by this process goes through here.
+
+    Each endpoint has an EndpointLimiter. Failed requests are retried with
+    tenacity: after a 429 every request to the endpoint waits for as long
+    as the reply asked, and other errors back off exponentially. Speech
+    requests can be hedged: one still unanswered after
+    OPENAI_HEDGE_PERCENTILE of recent latencies is sent again if the
+    limiter has a token to spare, and the first answer wins.
+    """
+
+    def __init__(self, rpm=OPENAI_RPM, max_attempts=OPENAI_MAX_ATTEMPTS, hedge_percentile=OPENAI_HEDGE_PERCENTILE):
+        self.limiters = {endpoint: EndpointLimiter(limit) for endpoint, limit in rpm.items()}
+        self.max_attempts = max_attempts
+        self.hedge_percentile = hedge_percentile
+        self._latencies = {endpoint: deque(maxlen=LATENCY_WINDOW) for endpoint in rpm}
+        self._hedge_pool = None
+        self._lock = threading.Lock()
+
+    def call(self, endpoint, send, job=None, hedge=False):
+        """Send `send(client)` as a request to `endpoint` and return its raw response.
+
+        `send` must use the client's `with_raw_response`, so the rate-limit
+        headers can be read; parse the result with `.parse()` or `.content`.
+        `job` is whose share of the endpoint the request counts against.
+        """
+        if hedge and self.hedge_percentile:
+            return self._hedged(endpoint, send, job)
+        return self._with_retries(endpoint, send, job)
+
+    def hedge_after(self, endpoint):
+        """Seconds after which a request to `endpoint` is hedged, or None before there's enough data."""
+        with self._lock:
+            latencies = sorted(self._latencies[endpoint])
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[max(0, math.ceil(self.hedge_percentile / 100 * len(latencies)) - 1)]
+
+    def _with_retries(self, endpoint, send, job, sent=None):
+        retrying = Retrying(
+            retry=retry_if_exception(retryable), stop=stop_after_attempt(self.max_attempts),
+            wait=_wait, reraise=True,
+        )
+        for attempt in retrying:
+            with attempt:
+                return self._attempt(endpoint, send, job, sent)
+
+    def _attempt(self, endpoint, send, job, sent=None, acquired=False):
+        limiter = self.limiters[endpoint]
+        if not acquired:
+            waited = limiter.acquire(job)
+            metrics.observe("gentext_openai_limiter_wait_seconds", waited, endpoint=endpoint)
+        if sent is not None:
+            sent.set()
+        start = time.perf_counter()
+        try:
+            with metrics.openai_request(endpoint):
+                response = send(get_client())
+        except Exception as e:
+            reply = getattr(e, "response", None)
+            if reply is not None:
+                limiter.observe(reply.headers, limited=reply.status_code == 429)
+            raise
+        limiter.observe(response.headers)
+        with self._lock:
+            self._latencies[endpoint].append(time.perf_counter() - start)
+        return response
+
+    def _hedged(self, endpoint, send, job):
+        threshold = self.hedge_after(endpoint)
+        pool = self._get_hedge_pool()
+        sent = threading.Event()
+        first = pool.submit(self._with_retries, endpoint, send, job, sent)
+        if threshold is None:
+            return first.result()
+
+        # The clock starts when the request goes out, not while it waits
+        # for the limiter
+        while not sent.wait(0.1):
+            if first.done():
+                return first.result()
+        try:
+            return first.result(timeout=threshold)
+        except FutureTimeout:
+            pass
+        if not self.limiters[endpoint].try_acquire():
+            return first.result()
+
+        second = pool.submit(self._attempt, endpoint, send, job, acquired=True)
+        for future in as_completed((first, second)):
+            if future.exception() is None:
+                metrics.inc("gentext_openai_hedges_total", endpoint=endpoint, result="won" if future is second else "lost")
+                return future.result()
+        return first.result()
+
+    def _get_hedge_pool(self):
+        with self._lock:
+            if self._hedge_pool is None:
+                # Threads are started as needed; each in-flight request and
+                # its hedge hold one
+                self._hedge_pool = ThreadPoolExecutor(max_workers=64, thread_name_prefix="openai")
+            return self._hedge_pool
+
+
+def retry_after(headers):
+    """Seconds a reply asks to wait before the next request, or None."""
+    milliseconds = _number(headers.get("retry-after-ms"))
+    if milliseconds is not None:
+        return milliseconds / 1000
+    value = headers.get("retry-after")
+    if value:
+        seconds = _number(value)
+        if seconds is not None:
+            return seconds
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    # Otherwise, until the quota has a request's worth again
+    refill = refill_rate(headers)
+    return 1 / refill if refill else None
+
+
+def refill_rate(headers):
+    """Requests a second the endpoint's quota refills at, from a reply's headers."""
+    limit = _number(headers.get("x-ratelimit-limit-requests"))
+    remaining = _number(headers.get("x-ratelimit-remaining-requests"))
+    reset = _duration(headers.get("x-ratelimit-reset-requests"))
+    if not (limit and reset) or remaining is None or remaining >= limit:
+        return None
+    return (limit - remaining) / reset
+
+
+def retryable(error):
+    """Whether an OpenAI error may not recur: a 429, a 5xx, a timeout or a lost connection."""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRY_STATUSES or status >= 500
+    # Connection errors and timeouts have no status
+    from openai import APIConnectionError
+
+    return isinstance(error, APIConnectionError)
+
+
+_backoff = wait_random_exponential(multiplier=0.5, max=20)
+
+
+def _wait(retry_state):
+    error = retry_state.outcome.exception()
+    response = getattr(error, "response", None)
+    if getattr(error, "status_code", None) == 429 and retry_after(response.headers) is not None:
+        # The endpoint's limiter holds every request until then
+        return 0
+    return _backoff(retry_state)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _duration(value):
+    # OpenAI writes reset times like "1s", "6m0s" or "20ms"
+    if not value:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return _number(value)
+    scale = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(amount) * scale[unit] for amount, unit in parts)
+
+
+# Shared by everything in this process
+openai_requests = RequestScheduler()
@@ -0,0 +1,108 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+def prefetch(iterable, max_ahead=2):
+    """Iterate `iterable` on a background thread, up to `max_ahead` items early (0: no limit).
+
+    The consumer gets the same items in the same order, but producing the
+    next ones overlaps with whatever the consumer does between items. An
+    exception raised by the producer is re-raised in the consumer at the
+    point it would have surfaced. Closing the generator early stops the
+    producer after the item it is working on.
+    """
+    items = queue.Queue(maxsize=max_ahead)
+    stopped = threading.Event()
+
+    def put(entry):
+        # Give up once the consumer has gone away, rather than block forever
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except BaseException as e:
+            put((_DONE, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def batched(iterable, size):
+    """Group items into lists of `size`; the last list may be shorter."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class SharedStream:
+    """A slow iterable read once on a background thread and replayed to every consumer.
+
+    For a source that produces items slowly, such as a conversation still
+    being written by the model: every consumer, on any thread, gets every
+    item in order as soon as it exists, without waiting for the others or
+    for the rest of the source. Items are kept, so a consumer that starts
+    late still sees them all. An exception raised by the source is
+    re-raised in each consumer after the items before it.
+    """
+
+    def __init__(self, iterable):
+        self._items = []
+        self._done = False
+        self._error = None
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._read, args=(iterable,), daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        i = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: i < len(self._items) or self._done)
+                if i >= len(self._items):
+                    if self._error is not None:
+                        raise self._error
+                    return
+                item = self._items[i]
+            yield item
+            i += 1
+
+    def _read(self, iterable):
+        try:
+            for item in iterable:
+                with self._changed:
+                    self._items.append(item)
+                    self._changed.notify_all()
+        except BaseException as e:
+            with self._changed:
+                self._error = e
+        finally:
+            with self._changed:
+                self._done = True
+                self._changed.notify_all()
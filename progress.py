@@ -0,0 +1,46 @@
+import threading
+import time
+
+# Share of total job time each stage usually takes. Stages can overlap, so
+# overall progress is the weighted sum of each stage's own completion.
+STAGE_WEIGHTS = {
+    "avatar": 0.02,
+    "tts": 0.45,
+    "audio": 0.05,
+    "frames": 0.28,
+    "encode": 0.20,
+}
+
+
+class ProgressReporter:
+    """Turns per-stage counters into throttled overall-progress callbacks.
+
+    `callback(stage, done, total, overall)` fires at most every
+    `min_interval` seconds, plus once whenever a stage completes, so it is
+    cheap to call update() for every TTS line or frame. Safe to call from
+    several threads.
+    """
+
+    def __init__(self, callback=None, min_interval=0.5):
+        self.callback = callback
+        self.min_interval = min_interval
+        self.fractions = dict.fromkeys(STAGE_WEIGHTS, 0.0)
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def overall(self):
+        return sum(STAGE_WEIGHTS[stage] * fraction for stage, fraction in self.fractions.items())
+
+    def update(self, stage, done, total):
+        fraction = min(1.0, done / total) if total else 1.0
+        with self._lock:
+            self.fractions[stage] = max(self.fractions[stage], fraction)
+            overall = self.overall
+            now = time.monotonic()
+            if self.callback is None:
+                return
+            if fraction < 1.0 and now - self._last_report < self.min_interval:
+                return
+            self._last_report = now
+        self.callback(stage, done, total, overall)
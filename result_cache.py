@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+from encoder import VIDEO_CRF, VIDEO_PRESET
+from draw_image import SCROLL_MODE
+
+# Bump whenever a change to rendering makes older videos stale, so cached
+# results from before the change are never served
+RENDER_VERSION = 3
+# Completed videos remembered for reuse; 0 turns the result cache off.
+# In-flight coalescing of identical requests stays on either way.
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 256))
+
+# Counter names kept in the job store
+CACHE_COUNTERS = ("hit", "coalesced", "created")
+
+
+def request_fingerprint(data):
+    """A stable hash of everything that decides what the video looks like.
+
+    Genders are folded to lower case like generate_video_from_json does, and
+    the conversation is serialized with sorted keys, so requests that would
+    render identically get the same fingerprint. Returns None for a payload
+    that can't be rendered anyway.
+    """
+    try:
+        canonical = {
+            "version": RENDER_VERSION,
+            "contact_name": data["contact_name"],
+            "contact_gender": data["contact_gender"].lower(),
+            "your_gender": data["your_gender"].lower(),
+            "convo": data["convo"],
+            "encoder": [VIDEO_PRESET, VIDEO_CRF],
+        }
+        # Only added for other modes, so paged videos cached before scroll
+        # modes existed keep their fingerprints
+        scroll_mode = data.get("scroll_mode") or SCROLL_MODE
+        if scroll_mode != "page":
+            canonical["scroll_mode"] = scroll_mode
+        if data.get("preview"):
+            canonical["preview"] = True
+        encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    except (KeyError, TypeError, AttributeError):
+        return None
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def video_available(job):
+    """Whether a completed job's video is still on disk to be served again.
+
+    Touches the file on success so the output sweep, which evicts the oldest
+    videos first, treats reused videos as recently used.
+    """
+    path = job.get("video_path")
+    if not path:
+        return False
+    try:
+        os.utime(path)
+    except OSError:
+        return False
+    return True
+
+
+def cache_stats(store):
+    counters = store.counters()
+    counts = {name: counters.get(name, 0) for name in CACHE_COUNTERS}
+    total = sum(counts.values())
+    return {
+        "enabled": RESULT_CACHE_MAX_ENTRIES > 0,
+        "entries": store.count_cached(),
+        "max_entries": RESULT_CACHE_MAX_ENTRIES,
+        "hits": counts["hit"],
+        "coalesced": counts["coalesced"],
+        "misses": counts["created"],
+        "hit_ratio": round(counts["hit"] / total, 3) if total else None,
+        "reuse_ratio": round((counts["hit"] + counts["coalesced"]) / total, 3) if total else None,
+    }
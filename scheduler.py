@@ -0,0 +1,342 @@
+import errno
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from job_store import JOB_MAX_ATTEMPTS, JOB_STALE_SECONDS, JOB_STORE, get_job_store
+from metrics import JOB_BUCKETS, job_profile, metrics
+from result_cache import RESULT_CACHE_MAX_ENTRIES, request_fingerprint, video_available
+from workspace import JobWorkspace
+
+# Server processes on this host (uvicorn --workers / gunicorn read the same
+# variable); each runs its own pool of JOB_WORKERS
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+# Rendering is CPU bound, so by default the host runs one job per core,
+# shared out between its server processes
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", max(1, (os.cpu_count() or 2) // WEB_CONCURRENCY)))
+# Jobs allowed to wait for a worker before /generate starts turning work away
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 32))
+# Load fonts, the sound effect, ffmpeg and the OpenAI client in each worker
+# as it starts, so its first job doesn't wait for them
+WORKER_WARMUP = os.getenv("WORKER_WARMUP", "1") != "0"
+# Start the worker processes with the server instead of on the first jobs
+WORKER_PRESTART = os.getenv("WORKER_PRESTART", "1") != "0"
+# Retry-After hint used until a few jobs have finished
+DEFAULT_JOB_SECONDS = 60
+# I/O errors a later attempt may not run into
+TRANSIENT_ERRNOS = (errno.EIO, errno.EAGAIN, errno.ENOSPC, errno.ENOMEM, errno.EMFILE, errno.ENFILE)
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Job queue is full")
+        self.retry_after = retry_after
+
+
+class RetryableJobError(Exception):
+    """A job failed for a reason that may not recur, so it is worth another attempt."""
+
+
+def warm_worker():
+    # Runs once in each new worker process. A failure here would break the
+    # pool, so it only costs the first job the time it was meant to save.
+    from main import warm_up
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"[WARN] Worker warm-up failed: {e}")
+
+
+def worker_ready():
+    return os.getpid()
+
+
+def run_job(data, job_id):
+    # Runs in a worker process; import here so the parent doesn't pay for
+    # the renderer and the function pickles by reference
+    from main import generate_video_from_json
+
+    # Progress goes straight to the shared store, where /status and
+    # /events pick it up from whichever server process they land on. An
+    # in-memory store lives in the parent, so it gets no progress and no
+    # stage metrics.
+    if JOB_STORE == "memory":
+        with job_profile(job_id), transient_errors_retryable():
+            return generate_video_from_json(data, job_id=job_id)
+    store = get_job_store()
+
+    def report(stage, done, total, overall):
+        try:
+            store.update(job_id, progress=round(overall, 3), stage=stage, stage_done=done, stage_total=total)
+        except Exception as e:
+            print(f"[WARN] Could not record progress for {job_id}: {e}")
+
+    try:
+        with job_profile(job_id), transient_errors_retryable():
+            return generate_video_from_json(data, job_id=job_id, progress_callback=report)
+    finally:
+        # Stage timings and OpenAI request counts from this job
+        metrics.flush(store)
+
+
+@contextmanager
+def transient_errors_retryable():
+    """Re-raise errors that may not recur as RetryableJobError.
+
+    Runs in the worker, where the original exception types are at hand; the
+    parent only sees what survives pickling. OpenAI errors worth retrying,
+    timeouts, lost connections and I/O errors like a full disk count;
+    anything else, such as a malformed conversation or ffmpeg rejecting its
+    input, would fail the same way again.
+    """
+    from openai_scheduler import retryable
+
+    try:
+        yield
+    except Exception as e:
+        if retryable(e) or isinstance(e, (ConnectionError, TimeoutError)) or getattr(e, "errno", None) in TRANSIENT_ERRNOS:
+            raise RetryableJobError(f"{type(e).__name__}: {e}") from e
+        raise
+
+
+class JobScheduler:
+    """Runs jobs from a shared job store on a fixed pool of worker processes.
+
+    At most `max_workers` jobs render at once in this process's pool, each in
+    its own process so PIL and ffmpeg work isn't serialized by the GIL. Jobs
+    wait in the store's FIFO queue; once `max_queued` are waiting and no
+    worker is free, submit() raises QueueFull with a Retry-After estimate.
+
+    Several schedulers (one per server worker process) can share a SQLite
+    store: each claims the oldest queued job when it has a free worker,
+    checks in for the jobs it is running, and re-queues jobs whose owner
+    stopped checking in.
+
+    A request identical to one already queued or rendering is attached to
+    that job instead of starting another, and one identical to a finished
+    job whose video is still on disk is answered with it straight away.
+    Neither counts against the queue limit.
+    """
+
+    def __init__(self, store, max_workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE, job_fn=run_job, poll_interval=1.0):
+        self.store = store
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.job_fn = job_fn
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._executor = None
+        self._running = set()
+        self._durations = deque(maxlen=20)
+        # Reentrant: a job that fails fast can be done before _dispatch adds
+        # its callback, which then runs _finished right there, lock held
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._poller = None
+
+    def start(self):
+        """Start running the queue; later calls do nothing.
+
+        Kept out of __init__ so importing a server module has no side
+        effects: a worker spawned by the pool re-imports the server's script
+        while it starts up (python server.py), and that copy must not run
+        the queue.
+        """
+        with self._lock:
+            if self._poller is not None:
+                return
+            # Pick up jobs orphaned by a previous crash or restart, then keep
+            # polling for work queued by other processes
+            requeued, failed = self.store.recover()
+            if requeued or failed:
+                print(f"[INFO] Recovered orphaned jobs: {requeued} re-queued, {failed} failed")
+            if WORKER_PRESTART:
+                self._prestart()
+            self._poller = threading.Thread(target=self._poll, daemon=True)
+            self._poller.start()
+
+    def submit(self, job_id, data):
+        """Queue `data` as job `job_id`, or reuse an identical job.
+
+        Returns (job_id, outcome), where outcome is "created", "coalesced" or
+        "hit" and job_id is the job the caller should follow.
+        """
+        with self._lock:
+            idle = len(self._running) < self.max_workers
+            allow_create = idle or self.store.count('queued') < self.max_queued
+            job_id, outcome = self._create(job_id, data, allow_create)
+            if outcome == "rejected":
+                raise QueueFull(self._retry_after())
+            if outcome == "created":
+                self._dispatch()
+            return job_id, outcome
+
+    def submit_batch(self, batch_id, items):
+        """Queue every payload in `items` as batch `batch_id`.
+
+        Each item goes through the same reuse as submit(), so repeats within
+        the batch or of earlier requests don't render twice. The batch is
+        taken whole or not at all: unless every item fits in the queue
+        limit, counting free workers, QueueFull is raised and nothing is
+        queued. Returns one {"job_id", "cache"} per item, in order.
+        """
+        with self._lock:
+            free = self.max_workers - len(self._running)
+            if self.store.count('queued') + len(items) > self.max_queued + free:
+                raise QueueFull(self._retry_after())
+            results = []
+            for data in items:
+                job_id, outcome = self._create(str(uuid.uuid4()), data, allow_create=True)
+                results.append({"job_id": job_id, "cache": outcome})
+            self.store.create_batch(batch_id, results)
+            self._dispatch()
+            return results
+
+    def batch_capacity(self):
+        """Most items a batch can have and still fit an empty queue."""
+        return self.max_queued + self.max_workers
+
+    def queue_position(self, job_id):
+        """1-based place in line, 0 once running, None otherwise."""
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        if job['status'] == 'processing':
+            return 0
+        if job['status'] == 'queued':
+            return self.store.queue_position(job_id)
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "running": len(self._running),
+                "queued": self.store.count('queued'),
+                "queue_size": self.max_queued,
+            }
+
+    def _create(self, job_id, data, allow_create):
+        # Caller holds self._lock
+        fingerprint = request_fingerprint(data)
+        if fingerprint is None:
+            if not allow_create:
+                return None, "rejected"
+            self.store.create(job_id, data)
+            return job_id, "created"
+        reusable = video_available if RESULT_CACHE_MAX_ENTRIES > 0 else (lambda job: False)
+        job_id, outcome = self.store.create_or_attach(job_id, data, fingerprint, reusable, allow_create)
+        if outcome != "rejected":
+            self.store.incr(outcome)
+        return job_id, outcome
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _poll(self):
+        last_recover = time.monotonic()
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                with self._lock:
+                    self.store.heartbeat(self.owner, list(self._running))
+                    self._dispatch()
+                if time.monotonic() - last_recover > JOB_STALE_SECONDS / 2:
+                    self.store.recover()
+                    last_recover = time.monotonic()
+            except Exception as e:
+                print(f"[WARN] Scheduler poll failed: {e}")
+
+    def _dispatch(self):
+        # Caller holds self._lock
+        while len(self._running) < self.max_workers:
+            job = self.store.claim_next(self.owner)
+            if job is None:
+                break
+            job_id = job['job_id']
+            self._running.add(job_id)
+            started = time.monotonic()
+            if job.get('created_at') and job.get('started_at'):
+                metrics.observe("gentext_job_queue_wait_seconds", job['started_at'] - job['created_at'], buckets=JOB_BUCKETS)
+            executor = self._get_executor()
+            try:
+                future = executor.submit(self.job_fn, job['payload'], job_id)
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+                executor = self._get_executor()
+                future = executor.submit(self.job_fn, job['payload'], job_id)
+            future.add_done_callback(lambda f, job_id=job_id, started=started, executor=executor: self._finished(job_id, started, f, executor))
+
+    def _finished(self, job_id, started, future, executor):
+        status = 'completed'
+        try:
+            output_path = future.result()
+            self.store.transition(job_id, 'processing', 'completed', video_path=output_path, progress=1.0)
+            self.store.trim_fingerprints(RESULT_CACHE_MAX_ENTRIES)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # A worker died mid-job; start a fresh pool for the next one
+                with self._lock:
+                    self._discard_executor(executor)
+            status = 'error'
+            job = self.store.get(job_id)
+            # Lost workers and transient errors are retried; anything else
+            # would only fail again
+            retry = isinstance(e, (BrokenProcessPool, RetryableJobError))
+            if retry and job and job['attempts'] < JOB_MAX_ATTEMPTS and self.store.transition(job_id, 'processing', 'queued', owner=None):
+                # Its workspace was kept, so the next attempt picks up from
+                # the last stage this one finished
+                status = 'retried'
+                print(f"[WARN] Job {job_id} failed on attempt {job['attempts']} of {JOB_MAX_ATTEMPTS}, re-queued: {e}")
+            else:
+                self.store.transition(job_id, 'processing', 'error', error=str(e))
+                JobWorkspace(job_id).cleanup()
+        if status == 'retried':
+            metrics.inc("gentext_job_retries_total")
+        else:
+            metrics.observe("gentext_job_duration_seconds", time.monotonic() - started, buckets=JOB_BUCKETS, status=status)
+            metrics.inc("gentext_jobs_finished_total", status=status)
+        metrics.flush(self.store)
+
+        with self._lock:
+            self._running.discard(job_id)
+            self._durations.append(time.monotonic() - started)
+            self._dispatch()
+
+    def _discard_executor(self, broken):
+        # Caller holds self._lock. Every job on a broken pool reports it,
+        # some only after _dispatch has replaced it, so only drop the pool
+        # if it is still the current one
+        if self._executor is broken:
+            self._executor = None
+            broken.shutdown(wait=False, cancel_futures=True)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn rather than fork: the web server process has threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=warm_worker if WORKER_WARMUP else None,
+            )
+        return self._executor
+
+    def _prestart(self):
+        # The pool spawns a worker whenever a task arrives and none is idle,
+        # so one no-op task per worker, sent at once, starts them all
+        executor = self._get_executor()
+        for _ in range(self.max_workers):
+            executor.submit(worker_ready)
+
+    def _retry_after(self):
+        # Caller holds self._lock
+        average = sum(self._durations) / len(self._durations) if self._durations else DEFAULT_JOB_SECONDS
+        waves = (self.store.count('queued') + len(self._running)) / self.max_workers
+        return max(1, int(average * waves))
@@ -1,10 +1,15 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 import os
 import uuid
-from main import generate_video
-import threading
-import time
+from scheduler import JobScheduler, QueueFull
+from job_store import get_job_store, public_job
+from result_cache import cache_stats
+from hls import playlist_url, stream_file
+from downloads import DOWNLOAD_CACHE_CONTROL, file_etag
+from draw_image import SCROLL_MODES
+from batches import BATCH_MAX_ITEMS, batch_status
+from metrics import render_metrics
 
 app = Flask(__name__)
 CORS(app, resources={
@@ -17,8 +22,15 @@ CORS(app, resources={
     }
 })
 
-# Store job status
-jobs = {}
+# Store job status, shared by every server worker on this host
+jobs = get_job_store()
+scheduler = JobScheduler(jobs)
+
+@app.before_request
+def start_scheduler():
+    # Under gunicorn the __main__ block below never runs, so the queue starts
+    # with the first request; start() is a no-op after that
+    scheduler.start()
 
 @app.route('/')
 def index():
@@ -27,47 +39,100 @@ def index():
 @app.route('/generate', methods=['POST'])
 def generate():
     data = request.json
+    if data.get('scroll_mode') is not None and data['scroll_mode'] not in SCROLL_MODES:
+        return jsonify({'error': f"scroll_mode must be one of {', '.join(SCROLL_MODES)}"}), 400
 
     job_id = str(uuid.uuid4())
-    jobs[job_id] = {
-        'status': 'processing',
-        'progress': 0,
-        'video_path': None,
-        'error': None
-    }
 
-    def generate_video_task():
-        try:
-            from main import generate_video_from_json
-            output_path = generate_video_from_json(data, job_id=job_id)
-            jobs[job_id]['status'] = 'completed'
-            jobs[job_id]['video_path'] = output_path
-        except Exception as e:
-            jobs[job_id]['status'] = 'error'
-            jobs[job_id]['error'] = str(e)
+    try:
+        job_id, outcome = scheduler.submit(job_id, data)
+    except QueueFull as e:
+        response = jsonify({'error': 'Too many jobs queued, try again later'})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 503
+
+    return jsonify({'job_id': job_id, 'cache': outcome})
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    items = (request.json or {}).get('items')
+    max_items = min(BATCH_MAX_ITEMS, scheduler.batch_capacity())
+    if not isinstance(items, list) or not items or len(items) > max_items:
+        return jsonify({'error': f'A batch needs 1 to {max_items} items'}), 400
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            return jsonify({'error': f'items[{i}] must be an object'}), 400
+        if item.get('scroll_mode') is not None and item['scroll_mode'] not in SCROLL_MODES:
+            return jsonify({'error': f"items[{i}]: scroll_mode must be one of {', '.join(SCROLL_MODES)}"}), 400
+
+    batch_id = str(uuid.uuid4())
+    try:
+        results = scheduler.submit_batch(batch_id, items)
+    except QueueFull as e:
+        response = jsonify({'error': 'Too many jobs queued for this batch, try again later'})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 503
+    return jsonify({'batch_id': batch_id, 'items': results})
 
-    thread = threading.Thread(target=generate_video_task)
-    thread.daemon = True
-    thread.start()
+@app.route('/batch/<batch_id>')
+def batch_progress(batch_id):
+    batch = jobs.get_batch(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(batch_status(jobs, batch))
 
-    return jsonify({'job_id': job_id})
+@app.route('/status')
+def service_status():
+    return jsonify({'scheduler': scheduler.stats(), 'result_cache': cache_stats(jobs)})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(render_metrics(jobs, scheduler), mimetype='text/plain; version=0.0.4')
 
 @app.route('/status/<job_id>')
 def status(job_id):
-    if job_id not in jobs:
+    job = jobs.get(job_id)
+    if job is None:
         return jsonify({'error': 'Job not found'}), 404
 
-    return jsonify(jobs[job_id])
+    return jsonify({**public_job(job), 'queue_position': scheduler.queue_position(job_id), 'stream_url': playlist_url(job_id)})
 
 @app.route('/download/<job_id>')
 def download(job_id):
-    if job_id not in jobs or jobs[job_id]['status'] != 'completed':
+    job = jobs.get(job_id)
+    if job is None or job['status'] != 'completed':
         return jsonify({'error': 'Video not ready'}), 404
 
-    video_path = jobs[job_id]['video_path']
-    return send_file(video_path, as_attachment=True)
+    video_path = job['video_path']
+    try:
+        etag = file_etag(os.stat(video_path))
+    except FileNotFoundError:
+        return jsonify({'error': 'Video expired'}), 410
 
-if __name__ == '__main__':
+    # conditional=True gives Range, If-Range and If-None-Match handling;
+    # full responses go out through wsgi.file_wrapper, which servers like
+    # gunicorn turn into sendfile()
+    response = send_file(
+        video_path, mimetype='video/mp4', as_attachment=True,
+        download_name=f"chat_video_{job_id}.mp4", conditional=True, etag=etag.strip('"'),
+    )
+    response.headers['Cache-Control'] = DOWNLOAD_CACHE_CONTROL
+    return response
+
+@app.route('/stream/<job_id>/<name>')
+def stream_segment(job_id, name):
+    found = stream_file(job_id, name) if jobs.get(job_id) is not None else None
+    if found is None:
+        return jsonify({'error': 'Stream not available'}), 404
 
+    path, media_type, cache_control = found
+    response = send_file(path, mimetype=media_type)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+if __name__ == '__main__':
+    # Started here rather than at import: spawned render workers re-import
+    # this script as __mp_main__ and must not run a queue of their own
+    scheduler.start()
     port = int(os.environ.get("PORT", 5001))  # fallback for local dev
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from downloads import file_etag, parse_range, plan_download
+
+SIZE = 1000
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "chat_video_test.mp4"
+    path.write_bytes(bytes(range(256)) * 3 + bytes(SIZE - 768))
+    return str(path)
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=500-", (500, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=1000-", "unsatisfiable"),
+    ("bytes=500-400", "unsatisfiable"),
+    ("bytes=-0", "unsatisfiable"),
+    ("bytes=0-10,20-30", None),
+    ("items=0-10", None),
+    ("bytes=-", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+def test_suffix_range(video):
+    status, headers, span = plan_download(video, {"range": "bytes=-100"})
+    assert status == 206
+    assert span == (900, 999)
+    assert headers["Content-Range"] == "bytes 900-999/1000"
+    assert headers["Content-Length"] == "100"
+
+
+def test_open_ended_range(video):
+    status, headers, span = plan_download(video, {"range": "bytes=250-"})
+    assert status == 206
+    assert span == (250, 999)
+    assert headers["Content-Length"] == "750"
+
+
+def test_unsatisfiable_range(video):
+    status, headers, span = plan_download(video, {"range": "bytes=1000-"})
+    assert status == 416
+    assert span is None
+    assert headers["Content-Range"] == "bytes */1000"
+
+
+def test_if_range(video):
+    etag = file_etag(os.stat(video))
+    status, _, span = plan_download(video, {"range": "bytes=0-9", "if-range": etag})
+    assert (status, span) == (206, (0, 9))
+
+    # A partial copy of some other file gets the whole of this one
+    status, headers, span = plan_download(video, {"range": "bytes=0-9", "if-range": '"1-3e8-0"'})
+    assert (status, span) == (200, (0, 999))
+    assert "Content-Range" not in headers
+
+    # If-Range needs a strong match
+    status, _, _ = plan_download(video, {"range": "bytes=0-9", "if-range": f"W/{etag}"})
+    assert status == 200
+
+
+def test_if_none_match(video):
+    etag = file_etag(os.stat(video))
+    status, headers, span = plan_download(video, {"if-none-match": etag})
+    assert (status, span) == (304, None)
+    assert headers["ETag"] == etag
+
+
+def test_etag_tells_apart_files_sharing_inode_and_size(video):
+    # What a later render that reuses an evicted video's inode looks like
+    before = os.stat(video)
+    os.utime(video, ns=(before.st_atime_ns, before.st_mtime_ns + 1))
+    after = os.stat(video)
+    assert (after.st_ino, after.st_size) == (before.st_ino, before.st_size)
+    assert file_etag(after) != file_etag(before)
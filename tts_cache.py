@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import unicodedata
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: eviction is only serialized within a process
+    fcntl = None
+
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join(os.path.dirname(__file__), "output", "tts_cache"))
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Eviction trims the cache to this share of its limit, so the next one is a
+# while off
+EVICT_TO = 0.9
+# Other processes write to the cache too; look at its real size at least this often
+EVICT_INTERVAL_SECONDS = 60
+
+
+def normalize_text(text):
+    """Collapse the differences that don't change what TTS says."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class TTSCache:
+    """Content-addressed store of synthesized lines, shared by threads and processes.
+
+    Entries live at <cache_dir>/<hh>/<sha256>.mp3, keyed on (model, voice,
+    normalized text). Writes land in a temp file and are renamed into place,
+    so readers never see a partial file. Every hit bumps the entry's mtime,
+    and eviction drops the least recently used entries once the directory
+    grows past `max_bytes`; a file lock keeps concurrent evictions from
+    racing. A `max_bytes` of 0 disables the cache.
+
+    Eviction has to list the whole directory, so put() doesn't: it adds
+    each entry's size to this process's estimate of the total and starts
+    an eviction on a background thread only when the estimate passes
+    `max_bytes`, or EVICT_INTERVAL_SECONDS after the last one. Each
+    eviction trims the cache to EVICT_TO of `max_bytes` and resets the
+    estimate to the real size.
+    """
+
+    def __init__(self, cache_dir=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._estimate = None  # bytes, as of the last eviction plus what this process added
+        self._evicted_at = 0.0
+        self._evicting = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, model, voice, text):
+        payload = json.dumps([model, voice, normalize_text(text)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.mp3")
+
+    def contains(self, model, voice, text):
+        return self.enabled and os.path.exists(self.path_for(self.key(model, voice, text)))
+
+    def get(self, model, voice, text, dest_path):
+        """Copy a cached line to dest_path. Returns True on a hit."""
+        if not self.enabled:
+            return False
+
+        entry = self.path_for(self.key(model, voice, text))
+        try:
+            os.utime(entry)
+            _link_or_copy(entry, dest_path)
+        except FileNotFoundError:
+            # Missing, or evicted by another worker between the two calls
+            return False
+        return True
+
+    def put(self, model, voice, text, src_path):
+        if not self.enabled:
+            return
+
+        entry = self.path_for(self.key(model, voice, text))
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_path = f"{entry}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, entry)
+
+        size = os.path.getsize(entry)
+        with self._lock:
+            if self._estimate is not None:
+                self._estimate += size
+            due = (self._estimate is None or self._estimate > self.max_bytes
+                   or time.monotonic() - self._evicted_at > EVICT_INTERVAL_SECONDS)
+            if not due or self._evicting:
+                return
+            self._evicting = True
+        threading.Thread(target=self._evict_in_background, daemon=True).start()
+
+    def _evict_in_background(self):
+        try:
+            self.evict()
+        except Exception as e:
+            print(f"[WARN] TTS cache eviction failed: {e}")
+        finally:
+            with self._lock:
+                self._evicting = False
+
+    def evict(self, target=None):
+        """Delete least recently used entries until the cache fits in `target` bytes.
+
+        `target` defaults to EVICT_TO of max_bytes, and nothing is deleted
+        while the cache is within max_bytes. Returns the number of bytes
+        reclaimed.
+        """
+        target = int(self.max_bytes * EVICT_TO) if target is None else target
+        with self._exclusive():
+            entries = []
+            total = 0
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    if not name.endswith(".mp3"):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+
+            reclaimed = 0
+            if total > self.max_bytes:
+                entries.sort()
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                    reclaimed += size
+
+        with self._lock:
+            self._estimate = total
+            self._evicted_at = time.monotonic()
+        return reclaimed
+
+    @contextmanager
+    def _exclusive(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, ".lock"), "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _link_or_copy(src, dest):
+    # A hard link is free and survives the entry being evicted later
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
@@ -0,0 +1,144 @@
+import os
+import shutil
+import time
+import uuid
+
+OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
+JOBS_DIR = os.path.join(OUTPUT_DIR, "jobs")
+VIDEOS_DIR = os.path.join(OUTPUT_DIR, "videos")
+STREAMS_DIR = os.path.join(OUTPUT_DIR, "streams")
+
+# Finished videos are kept this long, and the whole output tree is kept
+# under this many bytes, whichever bites first
+VIDEO_TTL_SECONDS = int(os.getenv("VIDEO_TTL_SECONDS", 24 * 60 * 60))
+OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_BYTES", 5 * 1024 * 1024 * 1024))
+
+
+class JobWorkspace:
+    """Private scratch directory for one job's intermediates.
+
+    Frames, voice lines, the avatar and the mixed soundtrack go here so that
+    concurrent jobs never share a path. Use it as a context manager: the
+    directory is created on entry and removed, with everything in it, on exit.
+    With `keep_failed` it is left in place when the job raises, so a later
+    run of the same job id can resume from what it holds.
+    """
+
+    def __init__(self, job_id=None, root=JOBS_DIR, keep_failed=False):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.keep_failed = keep_failed
+        self.path = os.path.join(root, self.job_id)
+        self.frames_dir = os.path.join(self.path, "frames")
+        self.audio_dir = os.path.join(self.path, "audio")
+
+    def __enter__(self):
+        self.create()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None or not self.keep_failed:
+            self.cleanup()
+
+    def create(self):
+        for path in (self.path, self.frames_dir, self.audio_dir):
+            os.makedirs(path, exist_ok=True)
+        return self
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def cleanup(self):
+        """Delete the workspace and return the number of bytes reclaimed."""
+        reclaimed = _tree_size(self.path)
+        shutil.rmtree(self.path, ignore_errors=True)
+        return reclaimed
+
+
+def video_path(job_id=None):
+    """Where a job's finished MP4 is published."""
+    os.makedirs(VIDEOS_DIR, exist_ok=True)
+    filename = f"chat_video_{job_id}.mp4" if job_id else "chat_video_scroll.mp4"
+    return os.path.join(VIDEOS_DIR, filename)
+
+
+def stream_dir(job_id):
+    """Where a job's HLS playlist and segments are published."""
+    return os.path.join(STREAMS_DIR, job_id)
+
+
+def sweep_outputs(ttl=None, max_bytes=None, now=None):
+    """Expire finished videos, HLS streams and abandoned workspaces.
+
+    Videos and streams older than `ttl` seconds go first; if they and the
+    workspaces together still exceed `max_bytes`, the oldest are evicted
+    until everything fits. Workspaces are removed by their owning job, or
+    when a failed job runs out of attempts, so one still on disk after `ttl`
+    belongs to a job that crashed. Returns a report of what was removed.
+    """
+    ttl = VIDEO_TTL_SECONDS if ttl is None else ttl
+    max_bytes = OUTPUT_MAX_BYTES if max_bytes is None else max_bytes
+    now = time.time() if now is None else now
+
+    report = {"files_evicted": 0, "workspaces_removed": 0, "bytes_reclaimed": 0}
+
+    if os.path.isdir(JOBS_DIR):
+        for name in os.listdir(JOBS_DIR):
+            path = os.path.join(JOBS_DIR, name)
+            try:
+                expired = now - os.stat(path).st_mtime > ttl
+            except FileNotFoundError:
+                continue
+            if expired:
+                report["bytes_reclaimed"] += _tree_size(path)
+                report["workspaces_removed"] += 1
+                shutil.rmtree(path, ignore_errors=True)
+
+    videos = []
+    if os.path.isdir(VIDEOS_DIR):
+        for name in os.listdir(VIDEOS_DIR):
+            path = os.path.join(VIDEOS_DIR, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            videos.append((st.st_mtime, st.st_size, path))
+    if os.path.isdir(STREAMS_DIR):
+        for name in os.listdir(STREAMS_DIR):
+            path = os.path.join(STREAMS_DIR, name)
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            videos.append((mtime, _tree_size(path), path))
+    videos.sort()
+
+    total = sum(size for _, size, _ in videos) + _tree_size(JOBS_DIR)
+    for mtime, size, path in videos:
+        if now - mtime <= ttl and total <= max_bytes:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+        total -= size
+        report["files_evicted"] += 1
+        report["bytes_reclaimed"] += size
+
+    if report["files_evicted"] or report["workspaces_removed"]:
+        print(f"[INFO] Output sweep evicted {report['files_evicted']} videos and "
+              f"{report['workspaces_removed']} workspaces, reclaimed {report['bytes_reclaimed']} bytes")
+    return report
+
+
+def _tree_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+    return total